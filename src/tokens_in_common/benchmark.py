@@ -0,0 +1,252 @@
+"""
+Benchmarks the stages of tree inference on synthetic option-string workloads, using a tiny randomly initialised Llama
+model on CPU, and compares the tree-masked forward with a naive forward of each leaf ancestry separately.
+
+Run with `python -m tokens_in_common.benchmark --help`.
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import string
+import threading
+import time
+from dataclasses import dataclass, field, asdict
+from typing import Callable, List, Optional, Tuple, Union
+
+import torch
+from tokenizers import Tokenizer, models, pre_tokenizers, trainers
+from transformers import LlamaConfig
+
+from tokens_in_common.data import OptionStringBuildMode, multitext_from_option_strings
+from tokens_in_common.modeling.gather import gather_paths
+from tokens_in_common.modeling.llama import LlamaModel
+from tokens_in_common.multitext import MultiText
+from tokens_in_common.profiling import current_rss
+from tokens_in_common.tokenization import tokenize_multitext
+
+STAGES = ['multitext_from_option_strings', 'tokenize_multitext', 'prepare_inputs', 'forward', 'naive_forward']
+
+
+def synthetic_option_strings(
+        depth: int, branching_factor: int, fragment_length: int, seed: int = 0
+) -> List[Union[str, Tuple[str]]]:
+    """
+    Generates an option-string workload of random words.
+    :param depth: the number of parts with options (i.e. branching points); each is preceded by a shared part.
+    :param branching_factor: the number of options per branching point.
+    :param fragment_length: the (approximate) number of characters in each part and option.
+    :param seed: seed for the random number generator.
+    """
+    rng = random.Random(seed)
+
+    def fragment():
+        words = []
+        while sum(len(w) + 1 for w in words) < fragment_length:
+            words.append(''.join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 8))))
+        return ' '.join(words) + ' '
+
+    text = []
+    for _ in range(depth):
+        text.append(fragment())
+        text.append(tuple(fragment() for _ in range(branching_factor)))
+    return text
+
+
+def train_tokenizer(texts: List[str], vocab_size: int = 512) -> Tokenizer:
+    """
+    Trains a small BPE tokenizer (with Llama-style metaspace pre-tokenization) on the given texts.
+    """
+    tokenizer = Tokenizer(models.BPE(unk_token='<unk>'))
+    tokenizer.pre_tokenizer = pre_tokenizers.Metaspace()
+    trainer = trainers.BpeTrainer(vocab_size=vocab_size, special_tokens=['<unk>'], show_progress=False)
+    tokenizer.train_from_iterator(texts, trainer)
+    return tokenizer
+
+
+def tiny_llama_config(**kwargs) -> LlamaConfig:
+    """
+    :param kwargs: overrides of the default (tiny) configuration values.
+    """
+    config = dict(
+        vocab_size=512, hidden_size=64, intermediate_size=172, num_hidden_layers=2, num_attention_heads=4,
+        max_position_embeddings=4096,
+    )
+    config.update(kwargs)
+    return LlamaConfig(**config)
+
+
+class PeakMemory:
+    """
+    Context manager that records the peak increase in resident set size while it is active, by sampling
+    `/proc/self/statm` from a background thread. The peak is `None` on platforms without procfs.
+    """
+
+    def __init__(self, interval: float = 0.001):
+        self.interval = interval
+        self.peak: Optional[int] = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self, baseline):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, current_rss() - baseline)
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        if os.path.exists('/proc/self/statm'):
+            baseline = current_rss()
+            self.peak = 0
+            self._thread = threading.Thread(target=self._sample, args=(baseline,), daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+        return False
+
+
+@dataclass
+class StageResult:
+    seconds: float
+    peak_memory: Optional[int]
+
+
+@dataclass
+class BenchmarkResult:
+    depth: int
+    branching_factor: int
+    fragment_length: int
+    mode: str
+    nr_leaves: int
+    nr_tree_tokens: int
+    nr_naive_tokens: int
+    max_abs_diff: float
+    stages: dict[str, StageResult] = field(default_factory=dict)
+
+    @property
+    def speedup(self):
+        return self.stages['naive_forward'].seconds / self.stages['forward'].seconds
+
+
+def tree_forward(model: LlamaModel, tokens, positions, attention_mask):
+    t_tokens = torch.LongTensor(tokens).unsqueeze(dim=0)
+    t_positions = torch.LongTensor(positions).unsqueeze(dim=0)
+    t_attention_mask = torch.LongTensor(attention_mask).unsqueeze(dim=0).unsqueeze(dim=0)
+    return model(input_ids=t_tokens, attention_mask=t_attention_mask, position_ids=t_positions).last_hidden_state
+
+
+def naive_forward(model: LlamaModel, multitext: MultiText[list[int]]) -> list[torch.Tensor]:
+    """
+    Forwards each leaf ancestry of the (tokenized) MultiText separately with a standard causal mask.
+    :return: the last hidden states of each leaf ancestry, in the order of `get_leaf_ancestries`.
+    """
+    results = []
+    for ancestry in multitext.get_leaf_ancestries():
+        tokens = sum((v.component.value for v in ancestry), start=[])
+        causal_mask = torch.tril(torch.ones(len(tokens), len(tokens), dtype=torch.long))
+        outputs = model(input_ids=torch.LongTensor([tokens]), attention_mask=causal_mask[None, None])
+        results.append(outputs.last_hidden_state[0])
+    return results
+
+
+def _time_stage(fn: Callable, repeats: int):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    with PeakMemory() as memory:
+        fn()
+    return result, StageResult(statistics.median(times), memory.peak)
+
+
+@torch.no_grad()
+def run_benchmark(
+        depth: int, branching_factor: int, fragment_length: int,
+        mode: OptionStringBuildMode = OptionStringBuildMode.STANDARD, model: Optional[LlamaModel] = None,
+        tokenizer: Optional[Tokenizer] = None, repeats: int = 3, seed: int = 0
+) -> BenchmarkResult:
+    """
+    Times each stage of tree inference on a synthetic workload, and the naive per-leaf forward for comparison.
+    :param model: the model to forward, defaults to a randomly initialised model with `tiny_llama_config()`.
+    :param tokenizer: the tokenizer to use, defaults to one trained on the synthetic workload.
+    """
+    option_strings = synthetic_option_strings(depth, branching_factor, fragment_length, seed=seed)
+    if tokenizer is None:
+        tokenizer = train_tokenizer([part for p in option_strings for part in ((p,) if isinstance(p, str) else p)])
+    if model is None:
+        torch.manual_seed(seed)
+        model = LlamaModel(tiny_llama_config(vocab_size=tokenizer.get_vocab_size())).eval()
+
+    stages = {}
+    multitext, stages['multitext_from_option_strings'] = _time_stage(
+        lambda: multitext_from_option_strings(mode, option_strings), repeats
+    )
+    tok_multitext, stages['tokenize_multitext'] = _time_stage(
+        lambda: tokenize_multitext(multitext, tokenizer.encode), repeats
+    )
+    (tokens, positions, attention_mask, _, index_maps), stages['prepare_inputs'] = _time_stage(
+        lambda: tok_multitext.prepare_inputs(
+            pos_method=MultiText.PositioningMethod.NO_ALIGNMENT, return_index_maps=True
+        ), repeats
+    )
+    tree_states, stages['forward'] = _time_stage(
+        lambda: tree_forward(model, tokens, positions, attention_mask), repeats
+    )
+    naive_states, stages['naive_forward'] = _time_stage(lambda: naive_forward(model, tok_multitext), repeats)
+
+    # check that the tree forward reproduces the naive forward
+    path_states, _ = gather_paths(tree_states[0], index_maps)
+    max_abs_diff = max(
+        (path_states[i, :len(naive)] - naive).abs().max().item() for i, naive in enumerate(naive_states)
+    )
+
+    return BenchmarkResult(
+        depth=depth, branching_factor=branching_factor, fragment_length=fragment_length, mode=mode.name,
+        nr_leaves=len(naive_states), nr_tree_tokens=len(tokens), nr_naive_tokens=sum(len(s) for s in naive_states),
+        max_abs_diff=max_abs_diff, stages=stages,
+    )
+
+
+def _format(result: BenchmarkResult):
+    lines = [
+        f'depth={result.depth} branching_factor={result.branching_factor} fragment_length={result.fragment_length} '
+        f'mode={result.mode}: {result.nr_leaves} leaves, {result.nr_tree_tokens} tree tokens vs. '
+        f'{result.nr_naive_tokens} naive tokens, speedup {result.speedup:.2f}x, max abs diff {result.max_abs_diff:.2e}'
+    ]
+    for name, stage in result.stages.items():
+        memory = f'{stage.peak_memory / 2 ** 20:10.2f} MiB' if stage.peak_memory is not None else 'n/a'
+        lines.append(f'  {name:<32}{stage.seconds * 1000:10.2f} ms{memory:>16}')
+    return '\n'.join(lines)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--depth', type=int, nargs='+', default=[1, 2, 3])
+    parser.add_argument('--branching-factor', type=int, nargs='+', default=[2, 4])
+    parser.add_argument('--fragment-length', type=int, nargs='+', default=[64])
+    parser.add_argument('--mode', choices=[m.name for m in OptionStringBuildMode], default='STANDARD')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='append the results as JSON lines to this file, to track them over time')
+    args = parser.parse_args(args)
+
+    for depth in args.depth:
+        for branching_factor in args.branching_factor:
+            for fragment_length in args.fragment_length:
+                result = run_benchmark(
+                    depth, branching_factor, fragment_length, mode=OptionStringBuildMode[args.mode],
+                    repeats=args.repeats, seed=args.seed,
+                )
+                print(_format(result))
+                if args.output is not None:
+                    with open(args.output, 'a') as f:
+                        f.write(json.dumps(dict(timestamp=time.time(), **asdict(result))) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+
+from tokens_in_common.multitext import IndexMaps, MultiText
+
+
+class PreparedInputsCache:
+    """
+    Caches the outputs of `MultiText.prepare_inputs` by `MultiText.structural_signature`, such that for MultiTexts of
+    the same shape (e.g. a template filled in with different samples) only the input_ids are rebuilt.
+    The cached position_ids, attention mask and index maps are shared between calls, so they should not be modified.
+    """
+
+    def __init__(self, maxsize: Optional[int] = None):
+        """
+        :param maxsize: the maximum number of signatures to keep, least recently used first out; unbounded if None.
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[tuple, tuple[list[int], list[list[bool]], IndexMaps]] = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def prepare_inputs(
+            self, multitext: MultiText[list[int]], pos_method=MultiText.PositioningMethod.FULL_ALIGNMENT
+    ) -> tuple[list[int], list[int], list[list[bool]], IndexMaps]:
+        """
+        :return: input_ids, position_ids, attention_mask and index maps, as returned by `MultiText.prepare_inputs`.
+        """
+        signature = multitext.structural_signature(pos_method)
+        if signature in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(signature)
+            position_ids, attention_mask, index_maps = self._entries[signature]
+            return self.input_ids(multitext, index_maps), position_ids, attention_mask, index_maps
+
+        self.misses += 1
+        input_ids, position_ids, attention_mask, _, index_maps = multitext.prepare_inputs(
+            pos_method=pos_method, return_index_maps=True
+        )
+        self._entries[signature] = (position_ids, attention_mask, index_maps)
+        if self.maxsize is not None and len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return input_ids, position_ids, attention_mask, index_maps
+
+    @staticmethod
+    def input_ids(multitext: MultiText[list[int]], index_maps: IndexMaps) -> list[int]:
+        """
+        Places the tokens of each vertex at its span in the inputs.
+        """
+        input_ids = np.zeros(int(index_maps.vertex_lengths.sum()), dtype=np.int64)
+        for v, (start, end) in zip(multitext.vertices, index_maps.vertex_spans):
+            input_ids[start:end] = v.component.value
+        return input_ids.tolist()
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
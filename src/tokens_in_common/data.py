@@ -1,9 +1,11 @@
 import itertools
 from enum import Enum
-from typing import List, Union, Tuple
+from typing import Callable, List, Optional, Union, Tuple
+
+from tokenizers import Encoding
 
 from tokens_in_common.multitext import MultiText
-from tokens_in_common.utils import Reference
+from tokens_in_common.utils import Reference, longest_common_prefix
 
 
 class OptionStringBuildMode(Enum):
@@ -77,3 +79,58 @@ def multitext_from_option_strings(mode: OptionStringBuildMode, text: List[Union[
             current_expansion *= len(part)
 
     return MultiText.from_vertex_elements(fragment_refs, parent_indices)
+
+
+def multitext_from_texts(
+        texts: List[str], tokenize_fn: Optional[Callable[[str], Encoding]] = None
+) -> Tuple[MultiText, float]:
+    """
+    A function to build a prefix-sharing MultiText from a list of complete texts, by recursively merging the longest
+    common prefixes of the texts (i.e. a radix trie).
+
+    The position of each vertex is its depth in the trie, so positions do not align the texts semantically; use
+    `MultiText.PositioningMethod.NO_ALIGNMENT` to give each token its position within its own text. A text that is a
+    prefix of another text ends in a leaf with an empty component, below the vertex where the longer text continues,
+    so that each distinct text has a leaf ancestry of its own. Duplicate texts share their leaf.
+    :param texts: The full texts of each variant.
+    :param tokenize_fn: If provided, each text is tokenized and the prefixes are merged on the token level, resulting
+    in a MultiText of token ids. Otherwise, the prefixes are merged on the character level.
+    :return: The MultiText, and its compression ratio: the total number of elements (characters or tokens) in the
+    separate texts divided by the number of elements in the MultiText.
+    """
+    if tokenize_fn is None:
+        sequences = list(texts)
+    else:
+        sequences = [tokenize_fn(text).ids for text in texts]
+
+    fragment_refs: List[Tuple[Reference, int]] = []
+    parent_indices = []
+    queue = [(sequences, None, 0)]  # the (remainders of) sequences, the index of their parent, and their position
+    while queue:
+        remainders, parent, pos = queue.pop(0)
+
+        # group the remainders by their first element, each group becomes a separate branch
+        groups = {}
+        ended = None
+        for remainder in remainders:
+            if len(remainder) > 0:
+                groups.setdefault(remainder[0], []).append(remainder)
+            else:
+                ended = remainder
+
+        # a text that ends here while others continue gets an empty leaf
+        if ended is not None and groups and parent is not None:
+            fragment_refs.append((Reference(ended), pos))
+            parent_indices.append([parent])
+
+        for group in groups.values():
+            prefix = longest_common_prefix(group)
+            fragment_refs.append((Reference(prefix), pos))
+            parent_indices.append([] if parent is None else [parent])
+            queue.append(([remainder[len(prefix):] for remainder in group], len(fragment_refs) - 1, pos + 1))
+
+    nr_separate = sum(len(seq) for seq in sequences)
+    nr_merged = sum(len(ref.value) for ref, _ in fragment_refs)
+    compression_ratio = nr_separate / nr_merged if nr_merged > 0 else 1.0
+
+    return MultiText.from_vertex_elements(fragment_refs, parent_indices), compression_ratio
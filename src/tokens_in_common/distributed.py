@@ -0,0 +1,224 @@
+"""
+Forwards a single large tree across processes: the trunk (the vertices that all leaf ancestries have in common) is
+forwarded once, its key/value cache is broadcast to all processes, and each process forwards a disjoint group of the
+subtrees below the trunk on top of it.
+"""
+import os
+import tempfile
+import time
+from dataclasses import dataclass
+from typing import Optional, Union
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn.functional as F
+
+from tokens_in_common.modeling.llama import LlamaForCausalLM, LlamaModel
+from tokens_in_common.multitext import IndexMaps, MultiText
+
+
+@dataclass
+class TreePartition:
+    """
+    A partition of the tokens returned by `MultiText.prepare_inputs`, see `partition_tree`.
+    """
+    trunk_token_indices: np.ndarray  # [nr_trunk_tokens], the tokens that every leaf ancestry contains
+    part_token_indices: list[np.ndarray]  # for each part, the tokens of its subtrees (sorted)
+
+
+def partition_tree(multitext: MultiText, index_maps: IndexMaps, nr_parts: int) -> TreePartition:
+    """
+    Splits the vertices that are not in the trunk into groups that are connected below the trunk, and divides these
+    groups over `nr_parts` parts of roughly equal numbers of tokens. Since the ancestors of a vertex are either in the
+    trunk or in its group, the tokens of each part only attend to the trunk and to the part itself.
+    :param index_maps: the index maps returned by `multitext.prepare_inputs`, which the partition indexes into.
+    """
+    vertices = list(multitext.vertices)
+    ancestries = [{id(v) for v in ancestry} for ancestry in multitext.get_leaf_ancestries()]
+    trunk = set.intersection(*ancestries) if ancestries else set()
+
+    # union-find over the arcs between vertices outside the trunk
+    roots = {id(v): id(v) for v in vertices if id(v) not in trunk}
+
+    def find(vertex_id):
+        while roots[vertex_id] != vertex_id:
+            roots[vertex_id] = roots[roots[vertex_id]]
+            vertex_id = roots[vertex_id]
+        return vertex_id
+
+    for v in vertices:
+        for child in v.children:
+            if id(v) not in trunk and id(child) not in trunk:
+                roots[find(id(child))] = find(id(v))
+
+    trunk_token_indices, groups = [], {}
+    for v, (start, end) in zip(vertices, index_maps.vertex_spans):
+        if id(v) in trunk:
+            trunk_token_indices.extend(range(start, end))
+        else:
+            groups.setdefault(find(id(v)), []).extend(range(start, end))
+
+    # largest group first, to the part with the fewest tokens
+    parts = [[] for _ in range(nr_parts)]
+    for group in sorted(groups.values(), key=len, reverse=True):
+        min(parts, key=len).extend(group)
+
+    return TreePartition(
+        trunk_token_indices=np.array(sorted(trunk_token_indices), dtype=np.int64),
+        part_token_indices=[np.array(sorted(part), dtype=np.int64) for part in parts],
+    )
+
+
+def _outputs(model, outputs):
+    return outputs.logits if isinstance(model, LlamaForCausalLM) else outputs.last_hidden_state
+
+
+def _output_spec(model):
+    # the size of the last dimension of the outputs, and their dtype
+    if isinstance(model, LlamaForCausalLM):
+        return model.config.vocab_size, torch.float32
+    return model.config.hidden_size, model.dtype
+
+
+@torch.no_grad()
+def distributed_forward(
+        model: Union[LlamaModel, LlamaForCausalLM], input_ids, position_ids, attention_mask, partition: TreePartition,
+        group: Optional[dist.ProcessGroup] = None
+) -> torch.Tensor:
+    """
+    Collective forward of a tree, which all processes in the group call with the same inputs. The process with rank 0
+    forwards the trunk and broadcasts its key/value cache, after which each process forwards the part of the partition
+    that corresponds to its rank.
+    :param input_ids: tokens of shape `(nr_tokens,)`, as returned by `MultiText.prepare_inputs`.
+    :param position_ids: position_ids of shape `(nr_tokens,)`.
+    :param attention_mask: 0/1 mask of shape `(nr_tokens, nr_tokens)`.
+    :param partition: the partition of the tokens, with a part for each process.
+    :return: on all processes, the logits (for a `LlamaForCausalLM`) or last hidden states of all tokens, of shape
+    `(1, nr_tokens, ...)` in the order of the inputs.
+    """
+    rank, world_size = dist.get_rank(group), dist.get_world_size(group)
+    if len(partition.part_token_indices) != world_size:
+        raise ValueError(f"The partition has {len(partition.part_token_indices)} parts, but there are {world_size} "
+                         f"processes.")
+    input_ids = torch.as_tensor(input_ids, dtype=torch.long)
+    position_ids = torch.as_tensor(position_ids, dtype=torch.long)
+    attention_mask = torch.as_tensor(attention_mask, dtype=torch.bool)
+    trunk = torch.as_tensor(partition.trunk_token_indices, dtype=torch.long)
+    parts = [torch.as_tensor(part, dtype=torch.long) for part in partition.part_token_indices]
+    output_size, output_dtype = _output_spec(model)
+
+    # forward the trunk once, and share its key/value cache and outputs
+    past_key_values = None
+    trunk_outputs = torch.empty((1, len(trunk), output_size), dtype=output_dtype)
+    if len(trunk) > 0:
+        if rank == 0:
+            outputs = model(
+                input_ids=input_ids[trunk].unsqueeze(0),
+                position_ids=position_ids[trunk].unsqueeze(0),
+                attention_mask=attention_mask[trunk][:, trunk].long()[None, None],
+                use_cache=True,
+            )
+            # collectives require contiguous tensors, while the cached values are a transposed view
+            past_key_values = tuple((k.contiguous(), v.contiguous()) for k, v in outputs.past_key_values)
+            trunk_outputs = _outputs(model, outputs).contiguous()
+        else:
+            config = model.config
+            head_dim = config.hidden_size // config.num_attention_heads
+            nr_kv_heads = getattr(config, 'num_key_value_heads', None) or config.num_attention_heads
+            shape = (1, nr_kv_heads, len(trunk), head_dim)
+            past_key_values = tuple(
+                (torch.empty(shape, dtype=model.dtype), torch.empty(shape, dtype=model.dtype))
+                for _ in range(config.num_hidden_layers)
+            )
+        for key_states, value_states in past_key_values:
+            dist.broadcast(key_states, src=0, group=group)
+            dist.broadcast(value_states, src=0, group=group)
+        dist.broadcast(trunk_outputs, src=0, group=group)
+
+    # forward this process's part on top of the trunk
+    part = parts[rank]
+    part_outputs = torch.empty((1, 0, output_size), dtype=output_dtype)
+    if len(part) > 0:
+        part_outputs = _outputs(model, model(
+            input_ids=input_ids[part].unsqueeze(0),
+            position_ids=position_ids[part].unsqueeze(0),
+            attention_mask=attention_mask[part][:, torch.cat([trunk, part])].long()[None, None],
+            past_key_values=past_key_values,
+            use_cache=False,
+        ))
+
+    # gather the parts and merge them into the order of the inputs
+    max_part_length = max(len(p) for p in parts)
+    padded = F.pad(part_outputs, (0, 0, 0, max_part_length - len(part)))
+    gathered = [torch.empty_like(padded) for _ in range(world_size)]
+    dist.all_gather(gathered, padded, group=group)
+
+    result = torch.empty((1, len(input_ids), output_size), dtype=output_dtype)
+    result[:, trunk] = trunk_outputs
+    for indices, outputs in zip(parts, gathered):
+        result[:, indices] = outputs[:, :len(indices)]
+    return result
+
+
+def _run_rank(rank, world_size, init_method, model, inputs, partition, results):
+    # every rank reports either its result (only needed from rank 0) or its exception, so the parent never waits forever.
+    # the exception is reported before the process group is destroyed, which makes the other processes fail as well,
+    # so the parent receives the original error first
+    try:
+        dist.init_process_group('gloo', init_method=init_method, rank=rank, world_size=world_size)
+        try:
+            result = distributed_forward(model, *inputs, partition)
+            results.put((rank, result.numpy() if rank == 0 else None, None))
+        except Exception as e:
+            results.put((rank, None, e))
+        finally:
+            dist.destroy_process_group()
+    except Exception as e:
+        results.put((rank, None, e))
+
+
+def run_distributed_forward(
+        model: Union[LlamaModel, LlamaForCausalLM], multitext: MultiText[list[int]], nr_processes: int = 2,
+        pos_method=MultiText.PositioningMethod.FULL_ALIGNMENT
+) -> torch.Tensor:
+    """
+    Forwards a tokenized MultiText with `distributed_forward` in `nr_processes` local processes, which share the model's
+    weights through shared memory.
+    :return: the logits (for a `LlamaForCausalLM`) or last hidden states of shape `(1, nr_tokens, ...)`, in the order
+    of the tokens returned by `multitext.prepare_inputs`.
+    """
+    tokens, positions, attention_mask, _, index_maps = multitext.prepare_inputs(
+        pos_method=pos_method, return_index_maps=True
+    )
+    partition = partition_tree(multitext, index_maps, nr_processes)
+    model.eval().share_memory()
+
+    with tempfile.TemporaryDirectory() as directory:
+        init_method = f'file://{os.path.join(directory, "rendezvous")}'
+        results = mp.get_context('spawn').SimpleQueue()
+        context = mp.spawn(
+            _run_rank, args=(nr_processes, init_method, model, (tokens, positions, attention_mask), partition, results),
+            nprocs=nr_processes, join=False
+        )
+        outputs = {}
+        try:
+            while len(outputs) < nr_processes:
+                if results.empty():
+                    if any(process.exitcode not in (None, 0) for process in context.processes):
+                        raise RuntimeError("A process of the distributed forward exited without reporting a result.")
+                    time.sleep(0.01)
+                    continue
+                rank, result, exception = results.get()
+                if exception is not None:
+                    raise exception
+                outputs[rank] = result
+        except BaseException:
+            # the other processes may be waiting in a collective for the failed one
+            for process in context.processes:
+                process.terminate()
+                process.join()
+            raise
+        context.join()
+    return torch.from_numpy(outputs[0])
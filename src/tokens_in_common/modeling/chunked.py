@@ -0,0 +1,45 @@
+from typing import Union
+
+import torch
+
+from tokens_in_common.modeling.llama import LlamaForCausalLM, LlamaModel
+from tokens_in_common.modeling.tree_cache import TreeKVCache
+
+
+@torch.no_grad()
+def chunked_prefill(
+        model: Union[LlamaModel, LlamaForCausalLM], input_ids, position_ids, attention_mask, chunk_size: int = 512,
+        **kwargs
+) -> tuple[torch.Tensor, TreeKVCache]:
+    """
+    Forwards a tree in chunks of `chunk_size` tokens, each of which attends to the cached keys and values of the earlier
+    chunks through its rows of the attention mask. The activations (hidden states and MLP) are thereby bounded by the
+    chunk size instead of the size of the tree. The attention scores of a chunk, of shape
+    `(num_heads, chunk_size, nr_cached_tokens + chunk_size)`, and the key/value cache still grow with the tree.
+    The tokens have to be in a topological order, i.e. the attention mask has to be lower triangular, which is the case
+    for the inputs prepared from a forest (see `MultiText.prepare_inputs`).
+    :param model: the model to forward.
+    :param input_ids: tokens of shape `(nr_tokens,)`, as returned by `MultiText.prepare_inputs`.
+    :param position_ids: position_ids of shape `(nr_tokens,)`.
+    :param attention_mask: 0/1 mask of shape `(nr_tokens, nr_tokens)`.
+    :param chunk_size: the number of tokens to forward at a time.
+    :param kwargs: passed on to the model's forward.
+    :return: the logits (for a `LlamaForCausalLM`) or last hidden states of shape `(1, nr_tokens, ...)`, and the cache
+    of the whole tree, which can be extended further.
+    """
+    input_ids = torch.as_tensor(input_ids, dtype=torch.long)
+    position_ids = torch.as_tensor(position_ids, dtype=torch.long)
+    attention_mask = torch.as_tensor(attention_mask, dtype=torch.bool)
+    if torch.triu(attention_mask, diagonal=1).any():
+        raise ValueError("Chunked prefill requires the tokens to only attend to earlier tokens (a lower triangular "
+                         "attention mask).")
+
+    cache = TreeKVCache(model)
+    outputs = []
+    for start in range(0, len(input_ids), chunk_size):
+        end = min(start + chunk_size, len(input_ids))
+        chunk_outputs = cache.extend_with_mask(
+            input_ids[start:end], attention_mask[start:end, :end], position_ids[start:end], **kwargs
+        )
+        outputs.append(chunk_outputs.logits if isinstance(model, LlamaForCausalLM) else chunk_outputs.last_hidden_state)
+    return torch.cat(outputs, dim=1), cache
@@ -0,0 +1,90 @@
+import bisect
+from collections import Counter
+from typing import Sequence, Union
+
+import torch
+
+from tokens_in_common.modeling.llama import LlamaForCausalLM, LlamaModel
+
+
+class CompiledTreeForward:
+    """
+    Runs tree forwards with a `torch.compile`d model. Since each tree has a different number of tokens, the inputs are
+    padded to the smallest of a fixed set of lengths (buckets), so a graph is compiled once per bucket and reused by all
+    trees that fit in it. Padding tokens only attend to themselves, and no other token attends to them, so they do not
+    affect the outputs of the tree. Trees longer than the largest bucket are forwarded without compilation.
+    Note that the number of buckets should not exceed `torch._dynamo.config.cache_size_limit`.
+    """
+
+    def __init__(
+            self, model: Union[LlamaModel, LlamaForCausalLM], buckets: Sequence[int] = (128, 256, 512, 1024, 2048),
+            pad_token_id: int = 0, **compile_kwargs
+    ):
+        """
+        :param model: the model to forward.
+        :param buckets: the lengths that the inputs are padded to.
+        :param pad_token_id: the token used for padding.
+        :param compile_kwargs: passed on to `torch.compile`, e.g. `backend` or `mode`.
+        """
+        self.model = model.eval()
+        self.buckets = sorted(buckets)
+        self.pad_token_id = pad_token_id
+        self._compiled = torch.compile(model, dynamic=False, **compile_kwargs)
+
+        self.nr_tokens = 0
+        self.nr_padding_tokens = 0
+        self.bucket_counts = Counter()  # the number of forwards per bucket, with None for the uncompiled forwards
+
+    @property
+    def padding_fraction(self):
+        """
+        The fraction of the forwarded tokens that were padding.
+        """
+        nr_forwarded = self.nr_tokens + self.nr_padding_tokens
+        return self.nr_padding_tokens / nr_forwarded if nr_forwarded > 0 else 0.
+
+    def bucket(self, nr_tokens: int):
+        """
+        :return: the length that `nr_tokens` tokens are padded to, or None if the tree does not fit in any bucket.
+        """
+        i = bisect.bisect_left(self.buckets, nr_tokens)
+        return self.buckets[i] if i < len(self.buckets) else None
+
+    @torch.no_grad()
+    def __call__(self, input_ids, position_ids, attention_mask) -> torch.Tensor:
+        """
+        :param input_ids: tokens of shape `(nr_tokens,)`, as returned by `MultiText.prepare_inputs`.
+        :param position_ids: position_ids of shape `(nr_tokens,)`.
+        :param attention_mask: 0/1 mask of shape `(nr_tokens, nr_tokens)`.
+        :return: the logits (for a `LlamaForCausalLM`) or last hidden states of the tokens, of shape
+        `(1, nr_tokens, ...)`.
+        """
+        input_ids = torch.as_tensor(input_ids, dtype=torch.long)
+        position_ids = torch.as_tensor(position_ids, dtype=torch.long)
+        attention_mask = torch.as_tensor(attention_mask, dtype=torch.bool)
+        nr_tokens = len(input_ids)
+
+        length = self.bucket(nr_tokens)
+        self.bucket_counts[length] += 1
+        self.nr_tokens += nr_tokens
+        if length is None:
+            model, length = self.model, nr_tokens
+        else:
+            model = self._compiled
+            self.nr_padding_tokens += length - nr_tokens
+
+        padded_input_ids = torch.full((length,), self.pad_token_id, dtype=torch.long)
+        padded_input_ids[:nr_tokens] = input_ids
+        padded_position_ids = torch.zeros(length, dtype=torch.long)
+        padded_position_ids[:nr_tokens] = position_ids
+        padded_attention_mask = torch.eye(length, dtype=torch.long)
+        padded_attention_mask[:nr_tokens, :nr_tokens] = attention_mask
+
+        outputs = model(
+            input_ids=padded_input_ids.unsqueeze(0),
+            position_ids=padded_position_ids.unsqueeze(0),
+            attention_mask=padded_attention_mask[None, None],
+            use_cache=False,
+        )
+        outputs = outputs.logits if isinstance(self.model, LlamaForCausalLM) else outputs.last_hidden_state
+        return outputs[:, :nr_tokens]
@@ -0,0 +1,46 @@
+from typing import Union
+
+import numpy as np
+import torch
+
+from tokens_in_common.multitext import IndexMaps
+
+
+def gather_tokens(
+        states: torch.Tensor, token_indices: Union[np.ndarray, torch.Tensor], pad_value: float = 0.
+) -> tuple[torch.Tensor, torch.Tensor]:
+    """
+    Gathers the states of the given tokens in a single indexing operation.
+    :param states: tensor of shape `(..., sequence_length, hidden_size)`, e.g. a hidden state or the logits.
+    :param token_indices: integer array of any shape with indices into the sequence dimension, padded with -1.
+    :param pad_value: value of the gathered states at padded indices.
+    :return: the gathered states of shape `(..., *token_indices.shape, hidden_size)`, and a boolean tensor of shape
+    `token_indices.shape` that is False where the indices were padded.
+    """
+    token_indices = torch.as_tensor(token_indices, dtype=torch.long, device=states.device)
+    valid = token_indices >= 0
+    gathered = states[..., token_indices.clamp(min=0), :]
+    return gathered.masked_fill(~valid.unsqueeze(-1), pad_value), valid
+
+
+def gather_paths(states: torch.Tensor, index_maps: IndexMaps, pad_value: float = 0.):
+    """
+    :return: the states of each leaf ancestry, of shape `(..., nr_leaves, max_path_length, hidden_size)`, and the
+    validity mask of shape `(nr_leaves, max_path_length)`.
+    """
+    return gather_tokens(states, index_maps.path_token_indices, pad_value=pad_value)
+
+
+def gather_leaves(states: torch.Tensor, index_maps: IndexMaps) -> torch.Tensor:
+    """
+    :return: the states of the last token of each leaf ancestry, of shape `(..., nr_leaves, hidden_size)`.
+    """
+    return gather_tokens(states, index_maps.leaf_last_token)[0]
+
+
+def gather_vertices(states: torch.Tensor, index_maps: IndexMaps, pad_value: float = 0.):
+    """
+    :return: the states of each vertex, of shape `(..., nr_vertices, max_vertex_length, hidden_size)`, and the
+    validity mask of shape `(nr_vertices, max_vertex_length)`.
+    """
+    return gather_tokens(states, index_maps.vertex_token_indices, pad_value=pad_value)
@@ -18,7 +18,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 """ PyTorch LLaMA model."""
-from typing import List, Optional, Tuple, Union
+import math
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Sequence, Tuple, Union
 
 import torch
 import torch.nn.functional as F
@@ -32,13 +34,43 @@ from transformers.modeling_outputs import BaseModelOutputWithPast, CausalLMOutpu
     SequenceClassifierOutputWithPast
 
 from transformers.models.llama.modeling_llama import LlamaDecoderLayer, LlamaRMSNorm, LLAMA_START_DOCSTRING, \
-    LlamaPreTrainedModel
+    LlamaPreTrainedModel, apply_rotary_pos_emb, repeat_kv
+
+from tokens_in_common.profiling import stage
 
 logger = logging.get_logger(__name__)
 
 _CONFIG_FOR_DOC = "LlamaConfig"
 
 
+@dataclass
+class TreeModelOutputWithPast(BaseModelOutputWithPast):
+    """
+    [`BaseModelOutputWithPast`] with additional outputs for tree inference.
+
+    Args:
+        captured_hidden_states (`tuple(torch.FloatTensor)`, *optional*, returned when `capture_layers` is passed without
+        a `capture_callback`):
+            Tuple with the hidden states of each layer in `capture_layers` (in the same order), restricted to the
+            tokens in `capture_token_indices`, of shape `(batch_size, len(capture_token_indices), hidden_size)`.
+        sparse_attention_indices (`torch.LongTensor` of shape `(nr_attended_pairs, 3)`, *optional*, returned when
+        `output_sparse_attentions=True`):
+            The batch, query and key index of each pair of tokens that is allowed by the attention mask.
+        sparse_attentions (`tuple(torch.FloatTensor)`, *optional*, returned when `output_sparse_attentions=True`):
+            Tuple with the attention weights of each layer at the pairs in `sparse_attention_indices`, of shape
+            `(nr_attended_pairs, num_heads)`.
+        vertex_attentions (`tuple(torch.FloatTensor)`, *optional*, returned when `attention_vertex_indices` is passed):
+            Tuple with the attention of each layer aggregated per pair of vertices, of shape
+            `(batch_size, num_heads, nr_vertices, nr_vertices)`. Each entry is the total attention of the tokens of the
+            query vertex to the tokens of the key vertex, averaged over the tokens of the query vertex.
+    """
+
+    captured_hidden_states: Optional[Tuple[torch.FloatTensor]] = None
+    sparse_attention_indices: Optional[torch.LongTensor] = None
+    sparse_attentions: Optional[Tuple[torch.FloatTensor]] = None
+    vertex_attentions: Optional[Tuple[torch.FloatTensor]] = None
+
+
 LLAMA_INPUTS_DOCSTRING = r"""
     Args:
         input_ids (`torch.LongTensor` of shape `(batch_size, sequence_length)`):
@@ -129,6 +161,15 @@ class LlamaModel(LlamaPreTrainedModel):
     def get_input_embeddings(self):
         return self.embed_tokens
 
+    def truncate_layers(self, num_layers: int):
+        """
+        Removes all decoder layers after the first `num_layers`, freeing their weights, e.g. after loading a model for
+        analyses of intermediate layers. To avoid loading the weights of the later layers in the first place, load the
+        model with `LlamaModel.from_pretrained(..., num_hidden_layers=num_layers)` instead.
+        """
+        self.layers = self.layers[:num_layers]
+        self.config.num_hidden_layers = len(self.layers)
+
     def set_input_embeddings(self, value):
         self.embed_tokens = value
 
@@ -144,12 +185,57 @@ class LlamaModel(LlamaPreTrainedModel):
         output_attentions: Optional[bool] = None,
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
-    ) -> Union[Tuple, BaseModelOutputWithPast]:
+        capture_layers: Optional[Sequence[int]] = None,
+        capture_token_indices: Optional[torch.LongTensor] = None,
+        capture_callback: Optional[Callable[[int, torch.Tensor], None]] = None,
+        stop_at_layer: Optional[int] = None,
+        normalize_at_stop: bool = False,
+        output_token_indices: Optional[torch.LongTensor] = None,
+        nr_pruned_layers: int = 1,
+        output_sparse_attentions: bool = False,
+        attention_vertex_indices: Optional[torch.LongTensor] = None,
+    ) -> Union[Tuple, TreeModelOutputWithPast]:
+        r"""
+        Args:
+            capture_layers (`Sequence[int]`, *optional*):
+                Indices of the hidden states to capture while the layers run, indexed like the `hidden_states` output
+                (i.e. 0 for the embeddings, `i` for the output of the i-th layer and `config.num_hidden_layers` for
+                the normalized output of the last layer). Negative indices count from the end.
+            capture_token_indices (`torch.LongTensor` of shape `(nr_captured_tokens,)`, *optional*):
+                Indices of the tokens for which the hidden states are captured, defaults to all tokens.
+            capture_callback (`Callable[[int, torch.Tensor], None]`, *optional*):
+                If passed, the captured hidden states are passed to this function (together with their index) as soon
+                as they are computed, instead of being kept and returned as `captured_hidden_states`.
+            stop_at_layer (`int`, *optional*):
+                If passed, only the first `stop_at_layer` decoder layers are run, and the output of the last of those
+                layers is returned as `last_hidden_state` (and as the last of the `hidden_states`). Negative values
+                count from the end.
+            normalize_at_stop (`bool`, *optional*, defaults to `False`):
+                Whether to apply the final norm to the output when stopping early with `stop_at_layer`.
+            output_token_indices (`torch.LongTensor` of shape `(nr_output_tokens,)`, *optional*):
+                If passed, `last_hidden_state` only contains the hidden states of these tokens (in this order), and the
+                last `nr_pruned_layers` layers only compute them. In those layers, queries are computed only for the
+                tokens that the outputs depend on (i.e. the tokens they attend to), and keys and values only for the
+                tokens that those attend to. Cannot be combined with `past_key_values`, `use_cache`,
+                `output_attentions` or `output_hidden_states`.
+            nr_pruned_layers (`int`, *optional*, defaults to 1):
+                The number of layers to prune with `output_token_indices`. For a tree mask, the tokens that the
+                outputs depend on are the same in all pruned layers, so more pruned layers save more.
+            output_sparse_attentions (`bool`, *optional*, defaults to `False`):
+                Whether to return the attention weights of each layer only at the pairs of tokens that the attention
+                mask allows, as `sparse_attentions` and `sparse_attention_indices`. The dense weights of only one layer
+                are kept at a time.
+            attention_vertex_indices (`torch.LongTensor` of shape `(sequence_length,)`, *optional*):
+                The index of the vertex of each token (e.g. `IndexMaps.token_vertex_indices`), -1 to leave a token out.
+                If passed, the attention of each layer is aggregated per pair of vertices as `vertex_attentions`.
+                Cannot be combined with `past_key_values`.
+        """
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
         output_hidden_states = (
             output_hidden_states if output_hidden_states is not None else self.config.output_hidden_states
         )
-        use_cache = use_cache if use_cache is not None else self.config.use_cache
+        if use_cache is None:
+            use_cache = self.config.use_cache and output_token_indices is None
 
         return_dict = return_dict if return_dict is not None else self.config.use_return_dict
 
@@ -181,11 +267,19 @@ class LlamaModel(LlamaPreTrainedModel):
             raise NotImplementedError('Flash Attention currently does not support specifying the attention mask on '
                                       'the token-pair level.')
         assert len(attention_mask.shape) == 4, "Attention mask must be 4d."
-        attention_mask = torch.where(
-            attention_mask.bool(),
-            torch.full(attention_mask.shape, fill_value=0),
-            torch.full(attention_mask.shape, fill_value=torch.finfo(self.dtype).min)
-        )
+        export_attentions = output_sparse_attentions or attention_vertex_indices is not None
+        if output_token_indices is not None:
+            if past_key_values is not None or use_cache or output_attentions or output_hidden_states \
+                    or export_attentions:
+                raise ValueError("Cannot prune layers with `output_token_indices` when using `past_key_values`, "
+                                 "`use_cache` or any of the attention or hidden state outputs.")
+            output_token_indices = output_token_indices.to(attention_mask.device)
+        with stage('mask_conversion', nr_tokens=batch_size * seq_length):
+            attention_mask = torch.where(
+                attention_mask.bool(),
+                torch.full(attention_mask.shape, fill_value=0),
+                torch.full(attention_mask.shape, fill_value=torch.finfo(self.dtype).min)
+            )
 
         # embed positions
         hidden_states = inputs_embeds
@@ -202,56 +296,214 @@ class LlamaModel(LlamaPreTrainedModel):
         all_self_attns = () if output_attentions else None
         next_decoder_cache = () if use_cache else None
 
-        for idx, decoder_layer in enumerate(self.layers):
+        sparse_indices, all_sparse_attns, all_vertex_attns = None, None, None
+        if export_attentions:
+            # the converted mask is zero at the attended pairs
+            sparse_indices = (attention_mask[:, 0] == 0).nonzero()
+            all_sparse_attns = () if output_sparse_attentions else None
+            if attention_vertex_indices is not None:
+                if past_key_values is not None:
+                    raise ValueError("Cannot aggregate attention per vertex when using `past_key_values`.")
+                all_vertex_attns = ()
+                vertex_pairs = self._vertex_pairs(sparse_indices, attention_vertex_indices.to(sparse_indices.device))
+
+        nr_states = len(self.layers) + 1
+        if stop_at_layer is not None:
+            if not -nr_states <= stop_at_layer < nr_states:
+                raise ValueError(f"Cannot stop at layer {stop_at_layer}, the model has {len(self.layers)} layers.")
+            stop_at_layer = stop_at_layer % nr_states
+        nr_layers = stop_at_layer if stop_at_layer is not None else len(self.layers)
+        nr_full_layers = nr_layers
+        if output_token_indices is not None:
+            if not 1 <= nr_pruned_layers <= nr_layers:
+                raise ValueError(f"Cannot prune {nr_pruned_layers} layers, {nr_layers} layers are run.")
+            nr_full_layers = nr_layers - nr_pruned_layers
+            token_sets = self._output_dependencies(attention_mask, output_token_indices, nr_pruned_layers)
+
+        if capture_layers is not None:
+            capture_layers = [layer_idx % nr_states for layer_idx in capture_layers]
+            if any(layer_idx > nr_layers for layer_idx in capture_layers):
+                raise ValueError("Cannot capture hidden states of layers after `stop_at_layer`.")
+            if any(layer_idx > nr_full_layers for layer_idx in capture_layers):
+                raise ValueError("Cannot capture hidden states of the layers pruned with `output_token_indices`.")
+        captured = {} if capture_layers is not None and capture_callback is None else None
+
+        for idx, decoder_layer in enumerate(self.layers[:nr_layers]):
             if output_hidden_states:
                 all_hidden_states += (hidden_states,)
-
-            past_key_value = past_key_values[idx] if past_key_values is not None else None
-
-            if self.gradient_checkpointing and self.training:
-                layer_outputs = self._gradient_checkpointing_func(
-                    decoder_layer.__call__,
-                    hidden_states,
-                    attention_mask,
-                    position_ids,
-                    past_key_value,
-                    output_attentions,
-                    use_cache,
-                )
-            else:
-                layer_outputs = decoder_layer(
-                    hidden_states,
-                    attention_mask=attention_mask,
-                    position_ids=position_ids,
-                    past_key_value=past_key_value,
-                    output_attentions=output_attentions,
-                    use_cache=use_cache,
-                )
-
-            hidden_states = layer_outputs[0]
-
-            if use_cache:
-                next_decoder_cache += (layer_outputs[2 if output_attentions else 1],)
-
-            if output_attentions:
-                all_self_attns += (layer_outputs[1],)
-
-        hidden_states = self.norm(hidden_states)
+            self._capture(idx, hidden_states, capture_layers, capture_token_indices, capture_callback, captured)
+
+            with stage('decoder_layer', nr_tokens=hidden_states.shape[0] * hidden_states.shape[1], index=idx):
+                if idx >= nr_full_layers:
+                    j = idx - nr_full_layers
+                    if j == 0:
+                        hidden_states = hidden_states[:, token_sets[0]]
+                    hidden_states = self._pruned_layer_forward(
+                        decoder_layer, hidden_states, attention_mask, position_ids, token_sets[j], token_sets[j + 1]
+                    )
+                    continue
+
+                past_key_value = past_key_values[idx] if past_key_values is not None else None
+
+                if self.gradient_checkpointing and self.training:
+                    layer_outputs = self._gradient_checkpointing_func(
+                        decoder_layer.__call__,
+                        hidden_states,
+                        attention_mask,
+                        position_ids,
+                        past_key_value,
+                        output_attentions or export_attentions,
+                        use_cache,
+                    )
+                else:
+                    layer_outputs = decoder_layer(
+                        hidden_states,
+                        attention_mask=attention_mask,
+                        position_ids=position_ids,
+                        past_key_value=past_key_value,
+                        output_attentions=output_attentions or export_attentions,
+                        use_cache=use_cache,
+                    )
+
+                hidden_states = layer_outputs[0]
+
+                if use_cache:
+                    next_decoder_cache += (layer_outputs[2 if output_attentions or export_attentions else 1],)
+
+                if output_attentions:
+                    all_self_attns += (layer_outputs[1],)
+
+                if export_attentions:
+                    weights = layer_outputs[1]
+                    sparse_attns = weights[sparse_indices[:, 0], :, sparse_indices[:, 1], sparse_indices[:, 2]]
+                    if output_sparse_attentions:
+                        all_sparse_attns += (sparse_attns,)
+                    if attention_vertex_indices is not None:
+                        all_vertex_attns += (self._aggregate_vertex_attentions(sparse_attns, weights.shape[0],
+                                                                               *vertex_pairs),)
+
+        if stop_at_layer is None or normalize_at_stop:
+            hidden_states = self.norm(hidden_states)
+        if output_token_indices is not None:
+            hidden_states = hidden_states[:, torch.searchsorted(token_sets[-1], output_token_indices)]
 
         # add hidden states from the last decoder layer
         if output_hidden_states:
             all_hidden_states += (hidden_states,)
+        self._capture(
+            nr_layers, hidden_states, capture_layers, capture_token_indices, capture_callback, captured
+        )
+        all_captured = tuple(captured[layer_idx] for layer_idx in capture_layers) if captured is not None else None
 
         next_cache = next_decoder_cache if use_cache else None
+        sparse_indices = sparse_indices if output_sparse_attentions else None
         if not return_dict:
-            return tuple(v for v in [hidden_states, next_cache, all_hidden_states, all_self_attns] if v is not None)
-        return BaseModelOutputWithPast(
+            return tuple(
+                v for v in [hidden_states, next_cache, all_hidden_states, all_self_attns, all_captured, sparse_indices,
+                            all_sparse_attns, all_vertex_attns] if v is not None
+            )
+        return TreeModelOutputWithPast(
             last_hidden_state=hidden_states,
             past_key_values=next_cache,
             hidden_states=all_hidden_states,
             attentions=all_self_attns,
+            captured_hidden_states=all_captured,
+            sparse_attention_indices=sparse_indices,
+            sparse_attentions=all_sparse_attns,
+            vertex_attentions=all_vertex_attns,
         )
 
+    @staticmethod
+    def _vertex_pairs(sparse_indices, attention_vertex_indices):
+        """
+        :return: for each attended pair, the index of its (batch, query vertex, key vertex) combination, which of the
+        pairs are between tokens that belong to a vertex, the number of vertices, and the number of tokens per vertex.
+        """
+        nr_vertices = int(attention_vertex_indices.max()) + 1 if len(attention_vertex_indices) > 0 else 0
+        query_vertices = attention_vertex_indices[sparse_indices[:, 1]]
+        key_vertices = attention_vertex_indices[sparse_indices[:, 2]]
+        valid = (query_vertices >= 0) & (key_vertices >= 0)
+        pair_indices = (sparse_indices[:, 0] * nr_vertices + query_vertices) * nr_vertices + key_vertices
+        vertex_sizes = torch.bincount(attention_vertex_indices[attention_vertex_indices >= 0], minlength=nr_vertices)
+        return pair_indices[valid], valid, nr_vertices, vertex_sizes
+
+    @staticmethod
+    def _aggregate_vertex_attentions(sparse_attns, batch_size, pair_indices, valid, nr_vertices, vertex_sizes):
+        nr_heads = sparse_attns.shape[1]
+        totals = torch.zeros((batch_size * nr_vertices * nr_vertices, nr_heads), dtype=torch.float32,
+                             device=sparse_attns.device)
+        totals.index_add_(0, pair_indices, sparse_attns[valid].float())
+        totals = totals.view(batch_size, nr_vertices, nr_vertices, nr_heads).permute(0, 3, 1, 2)
+        return totals / vertex_sizes.clamp(min=1).view(1, 1, -1, 1)
+
+    @staticmethod
+    def _output_dependencies(attention_mask, output_token_indices, nr_pruned_layers) -> list[torch.LongTensor]:
+        """
+        :return: the (sorted) indices of the tokens whose hidden states are needed before each pruned layer, and of the
+        output tokens after the last.
+        """
+        # the mask is already converted, with zeros for the attended pairs
+        attends = (attention_mask == 0).any(dim=0).any(dim=0)
+        token_sets = [torch.unique(output_token_indices)]
+        for _ in range(nr_pruned_layers):
+            needed = attends[token_sets[0]].any(dim=0)
+            needed[token_sets[0]] = True
+            token_sets.insert(0, needed.nonzero()[:, 0])
+        return token_sets
+
+    @staticmethod
+    def _pruned_layer_forward(layer: LlamaDecoderLayer, hidden_states, attention_mask, position_ids, kv_indices,
+                              query_indices):
+        """
+        Runs a decoder layer on the tokens in `kv_indices`, of which `hidden_states` are the inputs, and only returns
+        the outputs of the tokens in `query_indices` (a subset).
+        """
+        attn = layer.self_attn
+        bsz, kv_len, _ = hidden_states.shape
+        query_local = torch.searchsorted(kv_indices, query_indices)
+        q_len = len(query_local)
+
+        residual = hidden_states[:, query_local]
+        hidden_states = layer.input_layernorm(hidden_states)
+
+        query_states = attn.q_proj(hidden_states[:, query_local])
+        key_states = attn.k_proj(hidden_states)
+        value_states = attn.v_proj(hidden_states)
+        query_states = query_states.view(bsz, q_len, attn.num_heads, attn.head_dim).transpose(1, 2)
+        key_states = key_states.view(bsz, kv_len, attn.num_key_value_heads, attn.head_dim).transpose(1, 2)
+        value_states = value_states.view(bsz, kv_len, attn.num_key_value_heads, attn.head_dim).transpose(1, 2)
+
+        # the queries and keys are rotated by their own positions
+        query_positions, kv_positions = position_ids[:, query_indices], position_ids[:, kv_indices]
+        cos, sin = attn.rotary_emb(value_states, seq_len=int(kv_positions.max()) + 1)
+        query_states, _ = apply_rotary_pos_emb(query_states, query_states, cos, sin, query_positions)
+        key_states, _ = apply_rotary_pos_emb(key_states, key_states, cos, sin, kv_positions)
+
+        key_states = repeat_kv(key_states, attn.num_key_value_groups)
+        value_states = repeat_kv(value_states, attn.num_key_value_groups)
+
+        attn_weights = torch.matmul(query_states, key_states.transpose(2, 3)) / math.sqrt(attn.head_dim)
+        attn_weights = attn_weights + attention_mask[:, :, query_indices][:, :, :, kv_indices]
+        attn_weights = nn.functional.softmax(attn_weights, dim=-1, dtype=torch.float32).to(query_states.dtype)
+        attn_output = torch.matmul(attn_weights, value_states)
+        attn_output = attn_output.transpose(1, 2).reshape(bsz, q_len, attn.hidden_size)
+        hidden_states = residual + attn.o_proj(attn_output)
+
+        residual = hidden_states
+        hidden_states = layer.mlp(layer.post_attention_layernorm(hidden_states))
+        return residual + hidden_states
+
+    @staticmethod
+    def _capture(layer_idx, hidden_states, capture_layers, capture_token_indices, capture_callback, captured):
+        if capture_layers is None or layer_idx not in capture_layers:
+            return
+        if capture_token_indices is not None:
+            hidden_states = hidden_states.index_select(1, capture_token_indices.to(hidden_states.device))
+        if capture_callback is not None:
+            capture_callback(layer_idx, hidden_states)
+        else:
+            captured[layer_idx] = hidden_states
+
 
 class LlamaForCausalLM(LlamaPreTrainedModel):
     _tied_weights_keys = ["lm_head.weight"]
@@ -297,6 +549,10 @@ class LlamaForCausalLM(LlamaPreTrainedModel):
         output_attentions: Optional[bool] = None,
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
+        label_predecessors: Optional[torch.LongTensor] = None,
+        label_weights: Optional[torch.FloatTensor] = None,
+        output_token_indices: Optional[torch.LongTensor] = None,
+        nr_pruned_layers: int = 1,
     ) -> Union[Tuple, CausalLMOutputWithPast]:
         r"""
         Args:
@@ -304,6 +560,18 @@ class LlamaForCausalLM(LlamaPreTrainedModel):
                 Labels for computing the masked language modeling loss. Indices should either be in `[0, ...,
                 config.vocab_size]` or -100 (see `input_ids` docstring). Tokens with indices set to `-100` are ignored
                 (masked), the loss is only computed for the tokens with labels in `[0, ..., config.vocab_size]`.
+            label_predecessors (`torch.LongTensor` of shape `(batch_size, sequence_length)`, *optional*):
+                For a tree of tokens, the index of the token that precedes each token (-1 if none), as returned by
+                `MultiText.prepare_inputs` in `IndexMaps.token_predecessors`. If passed, each label is predicted by the
+                logits of its predecessor, instead of those of the previous token in the sequence.
+            label_weights (`torch.FloatTensor` of shape `(batch_size, sequence_length)`, *optional*):
+                Weights of each token's loss when using `label_predecessors`, e.g. `IndexMaps.token_loss_weights` to
+                average over the leaf ancestries of the tree. Defaults to weighing each token equally.
+            output_token_indices (`torch.LongTensor` of shape `(nr_output_tokens,)`, *optional*):
+                If passed, the logits are only computed for these tokens, see `LlamaModel.forward`. Cannot be combined
+                with `labels`.
+            nr_pruned_layers (`int`, *optional*, defaults to 1):
+                See `LlamaModel.forward`.
 
         Returns:
 
@@ -329,6 +597,8 @@ class LlamaForCausalLM(LlamaPreTrainedModel):
             output_hidden_states if output_hidden_states is not None else self.config.output_hidden_states
         )
         return_dict = return_dict if return_dict is not None else self.config.use_return_dict
+        if output_token_indices is not None and labels is not None:
+            raise ValueError("Cannot compute a loss when only computing the logits of `output_token_indices`.")
 
         # decoder outputs consists of (dec_features, layer_state, dec_hidden, dec_attn)
         outputs = self.model(
@@ -341,6 +611,8 @@ class LlamaForCausalLM(LlamaPreTrainedModel):
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
+            output_token_indices=output_token_indices,
+            nr_pruned_layers=nr_pruned_layers,
         )
 
         hidden_states = outputs[0]
@@ -353,7 +625,18 @@ class LlamaForCausalLM(LlamaPreTrainedModel):
         logits = logits.float()
 
         loss = None
-        if labels is not None:
+        if labels is not None and label_predecessors is not None:
+            # each token is predicted by its predecessor in the tree
+            label_predecessors = label_predecessors.to(logits.device)
+            labels = labels.to(logits.device)
+            log_probs = logits.log_softmax(dim=-1)
+            batch_indices = torch.arange(logits.shape[0], device=logits.device).unsqueeze(-1)
+            token_losses = -log_probs[batch_indices, label_predecessors.clamp(min=0), labels.clamp(min=0)]
+
+            weights = label_weights.to(logits.device) if label_weights is not None else torch.ones_like(token_losses)
+            weights = weights * ((label_predecessors >= 0) & (labels != -100))
+            loss = (token_losses * weights).sum() / weights.sum()
+        elif labels is not None:
             # Shift so that tokens < n predict n
             shift_logits = logits[..., :-1, :].contiguous()
             shift_labels = labels[..., 1:].contiguous()
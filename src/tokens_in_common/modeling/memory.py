@@ -0,0 +1,227 @@
+import itertools
+from dataclasses import dataclass, field
+from typing import Optional, Sequence
+
+import torch
+from transformers import LlamaConfig
+
+from tokens_in_common.multitext import MultiText, VertexID
+
+OPTIONAL_OUTPUTS = ('attentions', 'hidden_states', 'past_key_values', 'logits')
+
+
+@dataclass
+class MemoryPlan:
+    """
+    Predicted peak memory (in bytes) of forwarding a tree with `LlamaModel` or `LlamaForCausalLM`, and the sizes of the
+    components that are allocated at that peak.
+    """
+    nr_tokens: int
+    peak_bytes: int
+    breakdown: dict[str, int] = field(default_factory=dict)
+
+
+@dataclass
+class MemoryAdvice:
+    """
+    Suggested changes to make a tree forward fit into a memory budget, see `fit_memory_budget`.
+    """
+    fits: bool
+    drop_outputs: list[str]  # outputs (from `OPTIONAL_OUTPUTS`) to stop requesting
+    plan: MemoryPlan  # plan of the largest forward after applying the suggestions
+    leaf_groups: Optional[list[list[MultiText.Vertex]]] = None  # if the tree should be split, the leaves per part
+    multitexts: Optional[list[MultiText]] = None  # if the tree should be split, the parts
+    # if the tree should be split, the position_ids of the inputs of each part (in the order of its `prepare_inputs`)
+    # as they are in the full tree, to forward the parts with instead of their own
+    position_ids: Optional[list[list[int]]] = None
+
+
+def _element_size(dtype: torch.dtype):
+    return torch.empty((), dtype=dtype).element_size()
+
+
+def _plan(
+        nr_tokens: int, config: LlamaConfig, dtype: torch.dtype, outputs: Sequence[str], include_weights: bool,
+        include_inputs: bool
+) -> MemoryPlan:
+    n, d = nr_tokens, _element_size(dtype)
+    h, i, v = config.hidden_size, config.intermediate_size, config.vocab_size
+    nr_layers, nr_heads = config.num_hidden_layers, config.num_attention_heads
+    nr_kv_heads = getattr(config, 'num_key_value_heads', None) or nr_heads
+    kv_dim = nr_kv_heads * (h // nr_heads)
+    with_lm_head = 'logits' in outputs
+
+    persistent = {}
+    if include_weights:
+        layer_params = 2 * h * h + 2 * h * kv_dim + 3 * h * i + 2 * h
+        nr_params = v * h + nr_layers * layer_params + h
+        if with_lm_head and not config.tie_word_embeddings:
+            nr_params += v * h
+        persistent['weights'] = nr_params * d
+    if include_inputs:
+        # the nested lists returned by `prepare_inputs` and the int64 mask tensor created from them
+        persistent['input_mask'] = 8 * n * n + 56 * n + 8 * n * n
+    # the additive float32 mask that `LlamaModel.forward` converts the mask into
+    persistent['converted_mask'] = 4 * n * n
+
+    # transient allocations of each phase of the forward
+    phases = {
+        'mask_conversion': {'mask_conversion': (1 + 8 + 4) * n * n},
+        'attention': {
+            'residual_stream': 3 * n * h * d,
+            'qkv': 2 * n * (h + 2 * kv_dim) * d,
+            'attention_probabilities': nr_heads * n * n * max(d + 4, 8),
+        },
+        'mlp': {'residual_stream': 3 * n * h * d, 'mlp': 3 * n * i * d},
+    }
+    if with_lm_head:
+        phases['lm_head'] = {'logits': n * v * (d + 4 if d != 4 else 4)}
+
+    # outputs that accumulate over the layers, at the time of the last layer and after all layers respectively
+    accumulated = {name: {} for name in phases}
+    for name, nr_done in [('attention', nr_layers - 1), ('mlp', nr_layers), ('lm_head', nr_layers + 1)]:
+        if name not in phases:
+            continue
+        if 'hidden_states' in outputs:
+            accumulated[name]['hidden_states'] = min(nr_done + 1, nr_layers + 1) * n * h * d
+        if 'attentions' in outputs:
+            accumulated[name]['attentions'] = min(nr_done, nr_layers) * nr_heads * n * n * d
+        if 'past_key_values' in outputs:
+            accumulated[name]['past_key_values'] = 2 * min(nr_done + 1, nr_layers) * n * kv_dim * d
+
+    peak_phase = max(phases.keys(), key=lambda name: sum(phases[name].values()) + sum(accumulated[name].values()))
+    breakdown = dict(persistent)
+    breakdown.update(phases[peak_phase])
+    breakdown.update(accumulated[peak_phase])
+    return MemoryPlan(nr_tokens=n, peak_bytes=sum(breakdown.values()), breakdown=breakdown)
+
+
+def plan_forward_memory(
+        multitext: MultiText[list[int]], config: LlamaConfig, dtype: torch.dtype = torch.float32,
+        output_hidden_states: bool = False, output_attentions: bool = False, use_cache: Optional[bool] = None,
+        with_lm_head: bool = False, include_weights: bool = True, include_inputs: bool = True
+) -> MemoryPlan:
+    """
+    Predicts the peak memory of an inference (no_grad) forward of a tokenized MultiText, as prepared by
+    `MultiText.prepare_inputs`, with `LlamaModel` (or `LlamaForCausalLM` if `with_lm_head`). The prediction follows the
+    allocations of the eager attention implementation and ignores allocator overhead, so treat it as an estimate.
+    :param config: the configuration of the model.
+    :param dtype: the dtype of the model's parameters.
+    :param use_cache: whether the key/value cache is returned, defaults to `config.use_cache` like the forward does.
+    :param with_lm_head: whether the full-vocabulary logits are computed (i.e. `LlamaForCausalLM`).
+    :param include_weights: whether to include the model's parameters in the prediction.
+    :param include_inputs: whether to include the attention mask as returned by `prepare_inputs` and its tensor.
+    """
+    outputs = _requested_outputs(config, output_hidden_states, output_attentions, use_cache, with_lm_head)
+    nr_tokens = sum(len(v.component.value) for v in multitext.vertices)
+    return _plan(nr_tokens, config, dtype, outputs, include_weights, include_inputs)
+
+
+def fit_memory_budget(
+        multitext: MultiText[list[int]], config: LlamaConfig, budget_bytes: int, dtype: torch.dtype = torch.float32,
+        output_hidden_states: bool = False, output_attentions: bool = False, use_cache: Optional[bool] = None,
+        with_lm_head: bool = False, keep_outputs: Sequence[str] = (), include_weights: bool = True,
+        include_inputs: bool = True, pos_method=MultiText.PositioningMethod.FULL_ALIGNMENT
+) -> MemoryAdvice:
+    """
+    Suggests how to make the forward of a tokenized MultiText fit into a memory budget. First, the requested outputs
+    that are not in `keep_outputs` are dropped, largest first, until it fits. If dropping outputs does not suffice, the
+    leaves are (greedily, in the order of `get_leaf_ancestries`) packed into groups that fit, where each group is
+    forwarded as the subgraph of the leaves' ancestries.
+    With FULL_ALIGNMENT, the position_ids of a part depend on the lengths of the vertices left out of it, so the parts
+    should be forwarded with the returned `position_ids` (taken from the full tree) for their outputs to match those of
+    the full forward.
+    :param budget_bytes: the memory budget in bytes.
+    :param keep_outputs: names of outputs (see `OPTIONAL_OUTPUTS`) that may not be dropped.
+    :param pos_method: the positioning method that the tree is forwarded with.
+    For the other parameters, see `plan_forward_memory`.
+    """
+    outputs = _requested_outputs(config, output_hidden_states, output_attentions, use_cache, with_lm_head)
+    nr_tokens = sum(len(v.component.value) for v in multitext.vertices)
+
+    def plan(n, without=None):
+        return _plan(n, config, dtype, [o for o in outputs if o != without], include_weights, include_inputs)
+
+    # drop outputs, the one that reduces the peak the most first
+    drop_outputs = []
+    current = plan(nr_tokens)
+    droppable = [o for o in outputs if o not in keep_outputs]
+    while current.peak_bytes > budget_bytes and droppable:
+        largest = min(droppable, key=lambda o: plan(nr_tokens, without=o).peak_bytes)
+        droppable.remove(largest)
+        outputs.remove(largest)
+        drop_outputs.append(largest)
+        current = plan(nr_tokens)
+    if current.peak_bytes <= budget_bytes:
+        return MemoryAdvice(fits=True, drop_outputs=drop_outputs, plan=current)
+
+    # split the tree into groups of leaves
+    leaf_groups, group_vertices = [], []
+    for ancestry in multitext.get_leaf_ancestries():
+        vertices = {id(v): v for v in ancestry}
+        if group_vertices:
+            merged = {**group_vertices[-1], **vertices}
+            if plan(sum(len(v.component.value) for v in merged.values())).peak_bytes <= budget_bytes:
+                leaf_groups[-1].append(ancestry[-1])
+                group_vertices[-1] = merged
+                continue
+        leaf_groups.append([ancestry[-1]])
+        group_vertices.append(vertices)
+
+    current = max(
+        (plan(sum(len(v.component.value) for v in vertices.values())) for vertices in group_vertices),
+        key=lambda p: p.peak_bytes
+    )
+    multitexts, position_ids = [], []
+    for vertices in group_vertices:
+        part = multitext.subgraph(list(vertices.values()))
+        multitexts.append(part)
+        position_ids.append(_part_position_ids(multitext, part, vertices, pos_method))
+    return MemoryAdvice(
+        fits=current.peak_bytes <= budget_bytes,
+        drop_outputs=drop_outputs,
+        plan=current,
+        leaf_groups=leaf_groups,
+        multitexts=multitexts,
+        position_ids=position_ids,
+    )
+
+
+def _part_position_ids(
+        multitext: MultiText, part: MultiText, vertices: dict[VertexID, MultiText.Vertex],
+        pos_method: MultiText.PositioningMethod
+) -> list[int]:
+    """
+    :return: the position_ids of the inputs of `part`, the subgraph of `vertices`, as assigned in the full `multitext`.
+    """
+    _, position_ids, _, _, index_maps = part.prepare_inputs(pos_method=pos_method, return_index_maps=True)
+    if pos_method != MultiText.PositioningMethod.FULL_ALIGNMENT:
+        # the positions only depend on the ancestry of each vertex, which the part contains entirely
+        return position_ids
+
+    # with FULL_ALIGNMENT, a vertex starts after the longest vertex of each earlier position in its component
+    starts = {}
+    for v in vertices.values():
+        if id(v) in starts:
+            continue
+        component = v.get_weakly_connected_component()
+        max_lengths = [0] * (max(w.position for w in component) + 1)
+        for w in component:
+            max_lengths[w.position] = max(max_lengths[w.position], len(w.component.value))
+        position_starts = [0] + list(itertools.accumulate(max_lengths))
+        starts.update((id(w), position_starts[w.position]) for w in component)
+
+    # the subgraph keeps the order of the vertices
+    originals = [v for v in multitext.vertices if id(v) in vertices]
+    for v, (start, end) in zip(originals, index_maps.vertex_spans):
+        position_ids[start:end] = range(starts[id(v)], starts[id(v)] + end - start)
+    return position_ids
+
+
+def _requested_outputs(config, output_hidden_states, output_attentions, use_cache, with_lm_head):
+    use_cache = use_cache if use_cache is not None else config.use_cache
+    requested = dict(
+        attentions=output_attentions, hidden_states=output_hidden_states, past_key_values=use_cache,
+        logits=with_lm_head,
+    )
+    return [o for o in OPTIONAL_OUTPUTS if requested[o]]
@@ -0,0 +1,76 @@
+from typing import Optional, Union
+
+import torch
+import torch.nn.functional as F
+
+from tokens_in_common.modeling.llama import LlamaForCausalLM, LlamaModel
+
+
+class TreeKVCache:
+    """
+    The key/value cache of a tree of tokens. The tree is extended by forwarding only the new tokens, which attend to
+    their ancestors among the cached tokens through a tree-structured attention mask.
+    """
+
+    def __init__(self, model: Union[LlamaModel, LlamaForCausalLM]):
+        self.model = model
+        self.past_key_values = None
+        self.attention_mask = torch.zeros((0, 0), dtype=torch.bool)  # which tokens each cached token attends to
+        self.position_ids = torch.zeros(0, dtype=torch.long)
+
+    def __len__(self):
+        return self.attention_mask.shape[0]
+
+    def extend(
+            self, input_ids: torch.LongTensor, predecessors: torch.LongTensor,
+            position_ids: Optional[torch.LongTensor] = None, **kwargs
+    ):
+        """
+        Forwards new tokens, each of which attends to its predecessor and the tokens its predecessor attends to.
+        :param input_ids: tensor of shape `(nr_new_tokens,)`.
+        :param predecessors: tensor of shape `(nr_new_tokens,)` with the index of each token's predecessor, -1 for none.
+        The new tokens are indexed after the cached tokens, so a new token can be preceded by an earlier new token.
+        :param position_ids: tensor of shape `(nr_new_tokens,)`, defaults to the position of the predecessor plus one.
+        :param kwargs: passed on to the model's forward.
+        :return: the model's outputs for the new tokens.
+        """
+        nr_cached, nr_new = len(self), len(input_ids)
+        attention_mask = torch.zeros((nr_new, nr_cached + nr_new), dtype=torch.bool)
+        positions = torch.zeros(nr_new, dtype=torch.long)
+        for j, predecessor in enumerate(predecessors.tolist()):
+            if predecessor >= nr_cached + j:
+                raise ValueError("A token can only be preceded by a cached token or by an earlier new token.")
+            if predecessor >= nr_cached:
+                attention_mask[j] = attention_mask[predecessor - nr_cached]
+                positions[j] = positions[predecessor - nr_cached] + 1
+            elif predecessor >= 0:
+                attention_mask[j, :nr_cached] = self.attention_mask[predecessor]
+                positions[j] = self.position_ids[predecessor] + 1
+            attention_mask[j, nr_cached + j] = True
+        return self.extend_with_mask(input_ids, attention_mask, positions if position_ids is None else position_ids,
+                                     **kwargs)
+
+    def extend_with_mask(
+            self, input_ids: torch.LongTensor, attention_mask: torch.Tensor, position_ids: torch.LongTensor, **kwargs
+    ):
+        """
+        Forwards new tokens with an explicit attention mask.
+        :param input_ids: tensor of shape `(nr_new_tokens,)`.
+        :param attention_mask: boolean tensor of shape `(nr_new_tokens, len(self) + nr_new_tokens)`.
+        :param position_ids: tensor of shape `(nr_new_tokens,)`.
+        :param kwargs: passed on to the model's forward.
+        :return: the model's outputs for the new tokens.
+        """
+        attention_mask = torch.as_tensor(attention_mask, dtype=torch.bool)
+        outputs = self.model(
+            input_ids=torch.as_tensor(input_ids, dtype=torch.long).unsqueeze(0),
+            attention_mask=attention_mask.long()[None, None],
+            position_ids=torch.as_tensor(position_ids, dtype=torch.long).unsqueeze(0),
+            past_key_values=self.past_key_values,
+            use_cache=True,
+            **kwargs,
+        )
+        self.past_key_values = outputs.past_key_values
+        self.attention_mask = torch.cat([F.pad(self.attention_mask, (0, attention_mask.shape[0])), attention_mask])
+        self.position_ids = torch.cat([self.position_ids, torch.as_tensor(position_ids, dtype=torch.long)])
+        return outputs
@@ -1,3 +1,4 @@
+import hashlib
 from collections.abc import Iterator, Mapping
 from enum import Enum
 from typing import Optional, TypeVar, Generic
@@ -5,6 +6,7 @@ from dataclasses import dataclass, field
 
 import numpy as np
 
+from tokens_in_common.profiling import stage
 from tokens_in_common.utils import Reference
 
 T = TypeVar('T')
@@ -13,6 +15,65 @@ Component = Optional[Reference[Mapping[int, T]]]
 VertexID = int
 
 
+@dataclass
+class SharingReport:
+    """
+    Statistics on the savings of forwarding a MultiText as a whole, compared to forwarding each of its leaf ancestries
+    separately. FLOPs are estimated for a Llama-style decoder, counting a multiply-add as two FLOPs.
+    """
+    nr_leaves: int
+    nr_tokens: int
+    nr_path_tokens: int  # sum of the lengths of the leaf ancestries
+    nr_attended_pairs: int  # nr. of non-zero entries in the attention mask
+    attention_flops: int  # dense attention over all token pairs, as executed
+    sparse_attention_flops: int  # attention restricted to the attended pairs
+    naive_attention_flops: int
+    mlp_flops: int
+    naive_mlp_flops: int
+
+    @property
+    def mask_density(self):
+        return self.nr_attended_pairs / self.nr_tokens ** 2 if self.nr_tokens > 0 else 0.
+
+    @property
+    def compression_ratio(self):
+        return self.nr_path_tokens / self.nr_tokens if self.nr_tokens > 0 else 1.
+
+    @property
+    def flops(self):
+        return self.attention_flops + self.mlp_flops
+
+    @property
+    def naive_flops(self):
+        return self.naive_attention_flops + self.naive_mlp_flops
+
+
+@dataclass
+class IndexMaps:
+    """
+    Arrays of token indices into the inputs returned by `MultiText.prepare_inputs`, such that the outputs of a forward
+    can be gathered per vertex or per leaf ancestry in a single indexing operation (see `modeling.gather`).
+    Vertices are in the order of `MultiText.vertices` and leaves in the order of `MultiText.get_leaf_ancestries`.
+    Ragged arrays are padded with -1.
+    """
+    vertex_spans: np.ndarray  # [nr_vertices, 2], the start and end (exclusive) token index of each vertex
+    vertex_lengths: np.ndarray  # [nr_vertices]
+    vertex_token_indices: np.ndarray  # [nr_vertices, max_vertex_length]
+    path_lengths: np.ndarray  # [nr_leaves]
+    path_token_indices: np.ndarray  # [nr_leaves, max_path_length], the tokens of each leaf ancestry in order
+    leaf_last_token: np.ndarray  # [nr_leaves], the last token of each leaf ancestry
+    token_predecessors: np.ndarray  # [nr_tokens], the token preceding each token in the tree, -1 for none
+    token_loss_weights: np.ndarray  # [nr_tokens], weights that average a tree-aware loss over the leaf ancestries
+    token_vertex_indices: np.ndarray  # [nr_tokens], the index of the vertex that each token belongs to
+
+
+def _pad(rows: list[np.ndarray], pad_value=-1) -> np.ndarray:
+    result = np.full((len(rows), max((len(row) for row in rows), default=0)), pad_value, dtype=np.int64)
+    for i, row in enumerate(rows):
+        result[i, :len(row)] = row
+    return result
+
+
 @dataclass
 class MultiText(Generic[T]):
     """
@@ -30,10 +91,7 @@ class MultiText(Generic[T]):
 
         @property
         def siblings(self):
-            result = sum((p.children for p in self.parents), start=[])
-            if self in result:
-                result = result.remove(self)
-            return result
+            return [c for p in self.parents for c in p.children if c is not self]
 
         def get_ancestry(self, include_self=False):
             result = []
@@ -48,6 +106,30 @@ class MultiText(Generic[T]):
             hashable = sum((tuple(v.component.value) for v in ancestry), start=tuple())
             return hash(hashable)
 
+        def calc_stable_ancestral_hash(self, digest_size=16) -> bytes:
+            """
+            Like `calc_ancestral_component_hash`, a hash of the concatenated components of the ancestry, but one that is
+            the same across processes and Python sessions (a BLAKE2b digest), e.g. to store results by.
+            Components are either strings or lists of token ids.
+            """
+            # the ancestry in the order of `get_ancestry` without duplicates, visiting each ancestor once
+            ancestry, visited, stack = [], {id(self)}, [(self, iter(self.parents))]
+            while stack:
+                v, parents = stack[-1]
+                for parent in parents:
+                    if id(parent) not in visited:
+                        visited.add(id(parent))
+                        stack.append((parent, iter(parent.parents)))
+                        break
+                else:
+                    ancestry.append(stack.pop()[0])
+
+            digest = hashlib.blake2b(digest_size=digest_size)
+            for v in sorted(ancestry, key=lambda v: v.position):
+                value = v.component.value
+                digest.update(value.encode('utf-8') if isinstance(value, str) else np.asarray(value, '<i8').tobytes())
+            return digest.digest()
+
         def get_descendants(self, include_self=False):
             result = []
             for child in self.children:
@@ -71,6 +153,7 @@ class MultiText(Generic[T]):
 
     _vertices: list[Vertex] = field(default_factory=list)
     _arcs: list[tuple[Vertex, Vertex]] = field(default_factory=list)
+    _structure: dict[str, bool] = field(default_factory=dict, init=False, repr=False, compare=False)
 
     @property
     def vertices(self):
@@ -87,9 +170,9 @@ class MultiText(Generic[T]):
             parent.children.append(child)
             child.parents.append(parent)
 
-        # TODO check the following
-        #  - acyclic
-        #  - ancestry of any node cannot contain more than one node per position
+        if len(self._topological_order()) < len(self._vertices):
+            raise ValueError("A MultiText cannot contain cycles.")
+        # TODO check that the ancestry of any node cannot contain more than one node per position
 
     @classmethod
     def from_vertex_elements(cls, elements: list[tuple[Reference[T], int]], parent_indices: list[list[int]]):
@@ -103,18 +186,47 @@ class MultiText(Generic[T]):
 
     def get_leaf_ancestries(self) -> Iterator[list["MultiText.Vertex"]]:
         leafs = [v for v in self._vertices if len(v.children) == 0]
+        if self.is_forest() and self.is_causal():
+            # the ancestry is the chain of parents, which is already sorted by position
+            for leaf in leafs:
+                with stage('get_leaf_ancestries'):
+                    result = [leaf]
+                    while result[-1].parents:
+                        result.append(result[-1].parents[0])
+                yield result[::-1]
+            return
         for leaf in leafs:
-            result = leaf.get_ancestry(include_self=True)
-            sorted_vertices = sorted(result, key=lambda c: c.position)
+            with stage('get_leaf_ancestries'):
+                result = leaf.get_ancestry(include_self=True)
+                sorted_vertices = sorted(result, key=lambda c: c.position)
             yield sorted_vertices
 
-    def add_vertex(self, component, position, parents=None, children=None):
-        new_vertex = MultiText.Vertex(component, position, parents, children)
+    def add_vertex(self, component, position, parents=None, children=None) -> "MultiText.Vertex":
+        if children and parents:
+            # a cycle would be created if a child is an ancestor of a parent, visiting each ancestor once
+            child_ids = {id(child) for child in children}
+            visited = {id(p) for p in parents}
+            queue = list(parents)
+            for v in queue:
+                if id(v) in child_ids:
+                    raise ValueError("A MultiText cannot contain cycles.")
+                for parent in v.parents:
+                    if id(parent) not in visited:
+                        visited.add(id(parent))
+                        queue.append(parent)
+        self._structure.clear()
+
+        new_vertex = MultiText.Vertex(component, position)
         self._vertices.append(new_vertex)
-        if children is not None:
-            self._arcs.extend((new_vertex, child) for child in children)
-        if parents is not None:
-            self._arcs.extend((parent, new_vertex) for parent in parents)
+        for child in children or []:
+            self._arcs.append((new_vertex, child))
+            new_vertex.children.append(child)
+            child.parents.append(new_vertex)
+        for parent in parents or []:
+            self._arcs.append((parent, new_vertex))
+            parent.children.append(new_vertex)
+            new_vertex.parents.append(parent)
+        return new_vertex
 
     def copy(self, new_component_map: Optional[Mapping[VertexID, Reference[U]]]) -> "MultiText[U]":
         """
@@ -131,18 +243,124 @@ class MultiText(Generic[T]):
         arcs = [(vertices[id(a)], vertices[id(b)]) for a, b in self._arcs]
         return MultiText(_vertices=list(vertices.values()), _arcs=arcs)
 
+    def subgraph(self, vertices: list["MultiText.Vertex"]) -> "MultiText[T]":
+        """
+        Creates a MultiText of only the given vertices and the arcs between them, sharing their components.
+        Note that with FULL_ALIGNMENT, the position_ids of the subgraph can differ from those in the full MultiText.
+        """
+        ids = {id(v) for v in vertices}
+        new_vertices = {id(v): self.Vertex(v.component, v.position) for v in self._vertices if id(v) in ids}
+        arcs = [(new_vertices[id(a)], new_vertices[id(b)]) for a, b in self._arcs if id(a) in ids and id(b) in ids]
+        return MultiText(_vertices=list(new_vertices.values()), _arcs=arcs)
+
     class PositioningMethod(Enum):
         FULL_ALIGNMENT = 0
         NO_ALIGNMENT = 1
 
+    def structural_signature(self, pos_method=PositioningMethod.FULL_ALIGNMENT) -> tuple:
+        """
+        A hashable signature of everything `prepare_inputs` depends on apart from the token values: the vertices'
+        positions and lengths, the children of each vertex (in order), and the positioning method. MultiTexts with equal
+        signatures have equal position_ids, attention masks and index maps.
+        """
+        index = {id(v): i for i, v in enumerate(self._vertices)}
+        return (
+            pos_method,
+            tuple((v.position, len(v.component.value)) for v in self._vertices),
+            tuple(tuple(index[id(c)] for c in v.children) for v in self._vertices),
+        )
+
     def prepare_inputs(
-            self, pos_method=PositioningMethod.FULL_ALIGNMENT
-    ) -> tuple[list[int], list[int], list[list[bool]], list[tuple[Component, int, int]]]:
+            self, pos_method=PositioningMethod.FULL_ALIGNMENT, return_index_maps=False
+    ) -> tuple[list[int], list[int], list[list[bool]], list[tuple[Component, int, int]]] | tuple[
+        list[int], list[int], list[list[bool]], list[tuple[Component, int, int]], IndexMaps
+    ]:
         """
         Prepares the MultiText for input into a language model.
         :param pos_method: how to assign the tokens their position_ids
+        :param return_index_maps: whether to also return `IndexMaps` that locate the tokens of each vertex and leaf
+        ancestry in the inputs.
         :return: input_ids, position_ids, attention_mask, vertex elements (the component, vertex position, and
-        ancestral hash of each token).
+        ancestral hash of each token), and optionally the index maps.
+        """
+        with stage('prepare_inputs') as s:
+            if self.is_forest() and self.is_causal():
+                tokens, token_pos_ids, attention_mask, token_vertex_elements, idx = self._prepare_forest_inputs(
+                    pos_method
+                )
+            else:
+                tokens, token_pos_ids, attention_mask, token_vertex_elements, idx = self._prepare_dag_inputs(pos_method)
+            s.add_tokens(len(tokens))
+
+        if return_index_maps:
+            with stage('prepare_inputs.index_maps', nr_tokens=len(tokens)):
+                index_maps = self._index_maps(idx)
+            return tokens, token_pos_ids, attention_mask, token_vertex_elements, index_maps
+        return tokens, token_pos_ids, attention_mask, token_vertex_elements
+
+    def _position_starts(self, root: "MultiText.Vertex", nr_vertex_positions: int) -> list[int]:
+        """
+        :return: the first position_id of each vertex position, for FULL_ALIGNMENT in the component of `root`.
+        """
+        # first calculate the maximum length per vertex position in this weakly connected component
+        pos_max_length = [0] * nr_vertex_positions
+        for v in root.get_weakly_connected_component():
+            current_max = pos_max_length[v.position]
+            if len(v.component.value) > current_max:
+                pos_max_length[v.position] = len(v.component.value)
+        return [0] + list(np.cumsum(pos_max_length))
+
+    def _prepare_forest_inputs(self, pos_method: PositioningMethod):
+        """
+        `prepare_inputs` for causal forests. Each vertex has a single ancestry, so the mask rows of its tokens are a
+        copy of the row of its parent's last token, and the ancestral hashes are computed incrementally along the way.
+        """
+        roots = [v for v in self._vertices if len(v.parents) == 0]
+
+        tokens = []
+        token_pos_ids = []
+        token_vertex_elements = []
+
+        total_nr_elements = sum(len(v.component.value) for v in self._vertices)
+        attention_mask = np.zeros((total_nr_elements, total_nr_elements), dtype=bool)
+        nr_vertex_positions = len(set(v.position for v in self.vertices))
+        idx, last_idx, ancestral_values = {}, {}, {}
+        for root in roots:
+            if pos_method == MultiText.PositioningMethod.FULL_ALIGNMENT:
+                pos_starts = self._position_starts(root, nr_vertex_positions)
+
+            queue: list[tuple[MultiText.Vertex, MultiText.Vertex]] = [(root, None)]
+            for v, parent in queue:
+                # the last token of the nearest non-empty ancestor
+                parent_last_idx = last_idx[id(parent)] if parent is not None else -1
+                length = len(v.component.value)
+
+                if pos_method == MultiText.PositioningMethod.FULL_ALIGNMENT:
+                    start = pos_starts[v.position]
+                else:
+                    start = token_pos_ids[parent_last_idx] + 1 if parent_last_idx >= 0 else 0
+
+                start_idx, end_idx = len(tokens), len(tokens) + length
+                idx[id(v)] = (start_idx, end_idx)
+                last_idx[id(v)] = end_idx - 1 if length > 0 else parent_last_idx
+                ancestral_values[id(v)] = ancestral_values.get(id(parent), tuple()) + tuple(v.component.value)
+                tokens.extend(v.component.value)
+                token_pos_ids.extend(range(start, start + length))
+                token_vertex_elements.extend([(v.component, v.position, hash(ancestral_values[id(v)]))] * length)
+
+                if parent_last_idx >= 0:
+                    attention_mask[start_idx:end_idx] = attention_mask[parent_last_idx]
+                attention_mask[start_idx:end_idx, start_idx:end_idx] = np.tri(length, dtype=bool)
+
+                for child in v.children:
+                    queue.append((child, v))
+
+        return tokens, token_pos_ids, attention_mask.tolist(), token_vertex_elements, idx
+
+    def _prepare_dag_inputs(self, pos_method: PositioningMethod):
+        """
+        `prepare_inputs` for general MultiTexts, in which a vertex's tokens attend to the union of what its parents'
+        last tokens attend to.
         """
         # get root vertices
         roots = [v for v in self._vertices if len(v.parents) == 0]
@@ -158,12 +376,7 @@ class MultiText(Generic[T]):
         for root in roots:
             if pos_method == MultiText.PositioningMethod.FULL_ALIGNMENT:
                 # first calculate the maximum length per vertex position in this weakly connected component
-                pos_max_length = [0] * nr_vertex_positions
-                for v in root.get_weakly_connected_component():
-                    current_max = pos_max_length[v.position]
-                    if len(v.component.value) > current_max:
-                        pos_max_length[v.position] = len(v.component.value)
-                pos_starts = [0] + list(np.cumsum(pos_max_length))
+                pos_starts = self._position_starts(root, nr_vertex_positions)
 
             # traverse this root's subgraph
             queue: list[tuple[MultiText.Vertex, MultiText.Vertex]] = [(root, None)]
@@ -172,12 +385,11 @@ class MultiText(Generic[T]):
                 parent_last_idx = idx[id(parent)][1] - 1 if parent is not None else -1
                 length = len(v.component.value)
 
-                start = {   # where to start for the position_ids of this vertex
-                    MultiText.PositioningMethod.FULL_ALIGNMENT:
-                        pos_starts[v.position],
-                    MultiText.PositioningMethod.NO_ALIGNMENT:
-                        token_pos_ids[parent_last_idx] if parent is not None else 0,
-                }[pos_method]
+                # where to start for the position_ids of this vertex
+                if pos_method == MultiText.PositioningMethod.FULL_ALIGNMENT:
+                    start = pos_starts[v.position]
+                else:
+                    start = token_pos_ids[parent_last_idx] + 1 if parent is not None else 0
 
                 if id(v) not in idx:
                     # unseen vertex, extend `tokens`, `token_pos_ids` and `token_vertex_elements`
@@ -203,30 +415,191 @@ class MultiText(Generic[T]):
                 for child in v.children:
                     queue.append((child, v))
 
-        return tokens, token_pos_ids, attention_mask, token_vertex_elements
+        return tokens, token_pos_ids, attention_mask, token_vertex_elements, idx
+
+    def _index_maps(self, idx: Mapping[VertexID, tuple[int, int]]) -> IndexMaps:
+        vertex_spans = np.array([idx[id(v)] for v in self._vertices], dtype=np.int64).reshape(-1, 2)
+        vertex_lengths = vertex_spans[:, 1] - vertex_spans[:, 0]
+        vertex_token_indices = _pad([np.arange(start, end) for start, end in vertex_spans])
+
+        paths = [
+            np.concatenate([np.arange(*idx[id(v)]) for v in ancestry] + [np.zeros(0, dtype=np.int64)])
+            for ancestry in self.get_leaf_ancestries()
+        ]
+        path_lengths = np.array([len(path) for path in paths], dtype=np.int64)
+        path_token_indices = _pad(paths)
+        leaf_last_token = np.array([path[-1] if len(path) > 0 else -1 for path in paths], dtype=np.int64)
+
+        # the predecessor of a vertex's first token is the last token of its parent with the highest position
+        nr_tokens = int(vertex_lengths.sum())
+        token_predecessors = np.arange(-1, nr_tokens - 1, dtype=np.int64)
+        last_tokens = {}
+        for v in self._topological_order():
+            start, end = idx[id(v)]
+            parent = max(v.parents, key=lambda p: p.position, default=None)
+            predecessor = last_tokens[id(parent)] if parent is not None else -1
+            if end > start:
+                token_predecessors[start] = predecessor
+            last_tokens[id(v)] = end - 1 if end > start else predecessor
+
+        # weigh the tokens such that the loss equals the mean over the leaf ancestries of their mean token loss,
+        # instead of counting tokens that are shared by multiple leaf ancestries only once
+        token_loss_weights = np.zeros(nr_tokens, dtype=np.float64)
+        for path in paths:
+            predicted = path[token_predecessors[path] >= 0]
+            if len(predicted) > 0:
+                token_loss_weights[predicted] += 1 / (len(predicted) * len(paths))
+
+        token_vertex_indices = np.zeros(nr_tokens, dtype=np.int64)
+        for i, (start, end) in enumerate(vertex_spans):
+            token_vertex_indices[start:end] = i
+
+        return IndexMaps(
+            vertex_spans=vertex_spans,
+            vertex_lengths=vertex_lengths,
+            vertex_token_indices=vertex_token_indices,
+            path_lengths=path_lengths,
+            path_token_indices=path_token_indices,
+            leaf_last_token=leaf_last_token,
+            token_predecessors=token_predecessors,
+            token_loss_weights=token_loss_weights,
+            token_vertex_indices=token_vertex_indices,
+        )
+
+    def sharing_report(self, config=None) -> SharingReport:
+        """
+        Reports how much forwarding this MultiText saves compared to forwarding each leaf ancestry separately, without
+        materializing the attention mask. This takes O(V) time, plus O(V + E) for each vertex with multiple parents.
+        The element counts are in tokens for tokenized MultiTexts (or characters otherwise).
+        :param config: the `LlamaConfig` of the model used for the FLOPs estimates, defaults to that of Llama-2-7b.
+        """
+        if config is None:
+            from transformers import LlamaConfig
+            config = LlamaConfig()
+        hidden_size, intermediate_size = config.hidden_size, config.intermediate_size
+        num_hidden_layers, num_attention_heads = config.num_hidden_layers, config.num_attention_heads
+        num_key_value_heads = getattr(config, 'num_key_value_heads', None) or num_attention_heads
+        kv_dim = num_key_value_heads * (hidden_size // num_attention_heads)
+
+        ancestor_lengths = self._ancestor_lengths()
+
+        nr_leaves, nr_tokens, nr_path_tokens, nr_attended_pairs, naive_attention_pairs = 0, 0, 0, 0, 0
+        for v in self._vertices:
+            length = len(v.component.value)
+            nr_tokens += length
+            # each token attends to all tokens of its ancestors, and to itself and the tokens before it in its vertex
+            nr_attended_pairs += length * ancestor_lengths[id(v)] + length * (length + 1) // 2
+            if len(v.children) == 0:
+                path_length = ancestor_lengths[id(v)] + length
+                nr_leaves += 1
+                nr_path_tokens += path_length
+                naive_attention_pairs += path_length ** 2
+
+        def attention_flops(nr_queries, nr_pairs):
+            # the query and output projections, the (possibly smaller) key and value projections, and the scores and
+            # weighted values of all heads
+            projections = 4 * nr_queries * hidden_size * (hidden_size + kv_dim)
+            return num_hidden_layers * (projections + 4 * nr_pairs * hidden_size)
+
+        def mlp_flops(nr_queries):
+            return num_hidden_layers * 6 * nr_queries * hidden_size * intermediate_size
+
+        return SharingReport(
+            nr_leaves=nr_leaves,
+            nr_tokens=nr_tokens,
+            nr_path_tokens=nr_path_tokens,
+            nr_attended_pairs=nr_attended_pairs,
+            attention_flops=attention_flops(nr_tokens, nr_tokens ** 2),
+            sparse_attention_flops=attention_flops(nr_tokens, nr_attended_pairs),
+            naive_attention_flops=attention_flops(nr_path_tokens, naive_attention_pairs),
+            mlp_flops=mlp_flops(nr_tokens),
+            naive_mlp_flops=mlp_flops(nr_path_tokens),
+        )
+
+    def _topological_order(self) -> list["MultiText.Vertex"]:
+        in_degrees = {id(v): len(v.parents) for v in self._vertices}
+        queue = [v for v in self._vertices if in_degrees[id(v)] == 0]
+        for v in queue:
+            for child in v.children:
+                in_degrees[id(child)] -= 1
+                if in_degrees[id(child)] == 0:
+                    queue.append(child)
+        return queue
+
+    def _ancestor_lengths(self) -> dict[VertexID, int]:
+        """
+        :return: for each vertex, the total length of the components of its (strict) ancestors.
+        """
+        result = {}
+        for v in self._topological_order():
+            if len(v.parents) == 0:
+                result[id(v)] = 0
+            elif len(v.parents) == 1:
+                parent = v.parents[0]
+                result[id(v)] = result[id(parent)] + len(parent.component.value)
+            else:
+                # ancestors that are reachable by several paths are counted (and visited) once
+                queue = list({id(p): p for p in v.parents}.values())
+                visited = {id(p) for p in queue}
+                for a in queue:
+                    for p in a.parents:
+                        if id(p) not in visited:
+                            visited.add(id(p))
+                            queue.append(p)
+                result[id(v)] = sum(len(a.component.value) for a in queue)
+        return result
+
+    def _cached_structure(self, name: str, compute) -> bool:
+        # the structure only changes through `add_vertex`, which clears the cache
+        if name not in self._structure:
+            self._structure[name] = compute()
+        return self._structure[name]
 
     def is_causal(self):
         """
         :return: true if it has no arcs going backwards, false otherwise.
         """
-        raise NotImplementedError
+        return self._cached_structure('causal', lambda: all(a.position < b.position for a, b in self._arcs))
 
     def is_multitree(self):
         """
         :return: true if at most one path between any two vertices, false otherwise.
+        Takes O(E * V / 64) time, as the ancestor sets are kept as bitsets of V bits.
+        """
+        def compute():
+            # a second path exists iff two parents of a vertex share an ancestor (or are the same vertex), which is
+            # checked with the ancestor sets as bitsets, in topological order
+            order = self._topological_order()
+            ancestors = {}
+            for i, v in enumerate(order):
+                result = 1 << i
+                for parent in v.parents:
+                    if ancestors[id(parent)] & result:
+                        return False
+                    result |= ancestors[id(parent)]
+                ancestors[id(v)] = result
+            return True
+        return self._cached_structure('multitree', compute)
+
+    def is_forest(self):
         """
-        raise NotImplementedError
+        :return: true if no vertex has more than one parent, false otherwise.
+        """
+        return self._cached_structure('forest', lambda: all(len(v.parents) <= 1 for v in self._vertices))
 
     def is_tree(self):
         """
-        :return:
+        :return: true if it is a forest with a single root, false otherwise.
         """
-        raise NotImplementedError
+        return self._cached_structure(
+            'tree', lambda: self.is_forest() and sum(len(v.parents) == 0 for v in self._vertices) == 1
+        )
 
     def __add__(self, other: "MultiText"):
-        vertices = self._vertices + other._vertices
-        arcs = self._arcs + other._arcs
-        return MultiText(_vertices=vertices, _arcs=arcs)
+        # create new vertices, so the parents and children of the vertices in the operands are left untouched
+        vertices = {id(v): self.Vertex(v.component, v.position) for v in self._vertices + other._vertices}
+        arcs = [(vertices[id(a)], vertices[id(b)]) for a, b in self._arcs + other._arcs]
+        return MultiText(_vertices=list(vertices.values()), _arcs=arcs)
 
     def render_with_graphviz(self, name, label_fn=str, **kwargs):
         import graphviz
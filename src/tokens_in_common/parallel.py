@@ -0,0 +1,122 @@
+import itertools
+import threading
+from concurrent.futures import Future
+from typing import Iterable, Union
+
+import torch
+import torch.multiprocessing as mp
+
+from tokens_in_common.modeling.llama import LlamaForCausalLM, LlamaModel
+from tokens_in_common.multitext import MultiText
+
+
+def prepare_batch(
+        multitext: MultiText[list[int]], pos_method=MultiText.PositioningMethod.FULL_ALIGNMENT
+) -> dict[str, torch.Tensor]:
+    """
+    :return: the inputs of a forward of a tokenized MultiText, as keyword arguments of the model's forward.
+    """
+    tokens, positions, attention_mask, _ = multitext.prepare_inputs(pos_method=pos_method)
+    return dict(
+        input_ids=torch.LongTensor([tokens]),
+        position_ids=torch.LongTensor([positions]),
+        attention_mask=torch.BoolTensor(attention_mask)[None, None],
+    )
+
+
+def _worker(model, tasks: mp.Queue, results: mp.Queue, nr_threads: int):
+    torch.set_num_threads(nr_threads)
+    while (task := tasks.get()) is not None:
+        task_id, inputs = task
+        try:
+            use_cache = inputs.pop('use_cache', False)
+            with torch.no_grad():
+                outputs = model(**inputs, use_cache=use_cache)
+            result = outputs.logits if isinstance(model, LlamaForCausalLM) else outputs.last_hidden_state
+            results.put((task_id, result, None))
+        except Exception as e:
+            results.put((task_id, None, e))
+
+
+class SharedModelExecutor:
+    """
+    Forwards prepared tree batches in multiple worker processes, which share a single copy of the model's weights
+    through shared memory. Each worker runs with its own (small) number of threads, so throughput scales with the number
+    of cores also for small trees, for which a single forward does not use many cores efficiently.
+    """
+
+    def __init__(self, model: Union[LlamaModel, LlamaForCausalLM], nr_workers: int = 2, nr_threads_per_worker: int = 1):
+        """
+        :param model: the model to forward; its parameters and buffers are moved into shared memory.
+        :param nr_workers: the number of worker processes.
+        :param nr_threads_per_worker: the number of threads each worker uses for its forwards.
+        """
+        self.model = model.eval()
+        self.model.share_memory()
+
+        context = mp.get_context('spawn')
+        self._tasks = context.Queue()
+        self._results = context.Queue()
+        self._workers = [
+            context.Process(target=_worker, args=(self.model, self._tasks, self._results, nr_threads_per_worker),
+                            daemon=True)
+            for _ in range(nr_workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+        self._futures: dict[int, Future] = {}
+        self._lock = threading.Lock()
+        self._task_ids = itertools.count()
+        self._collector = threading.Thread(target=self._collect, daemon=True)
+        self._collector.start()
+
+    def _collect(self):
+        while (result := self._results.get()) is not None:
+            task_id, output, exception = result
+            with self._lock:
+                future = self._futures.pop(task_id)
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(output)
+
+    def submit(self, **inputs) -> Future:
+        """
+        Submits a batch to be forwarded by the first available worker.
+        :param inputs: keyword arguments of the model's forward, e.g. as returned by `prepare_batch`.
+        :return: a future of the logits (for a `LlamaForCausalLM`) or last hidden states.
+        """
+        if self._workers is None:
+            raise RuntimeError("The executor has been closed.")
+        future = Future()
+        task_id = next(self._task_ids)
+        with self._lock:
+            self._futures[task_id] = future
+        self._tasks.put((task_id, inputs))
+        return future
+
+    def map(self, batches: Iterable[dict[str, torch.Tensor]]) -> list[torch.Tensor]:
+        """
+        Forwards the batches in parallel.
+        :return: the outputs of each batch, in order.
+        """
+        futures = [self.submit(**batch) for batch in batches]
+        return [future.result() for future in futures]
+
+    def close(self):
+        if self._workers is None:
+            return
+        for _ in self._workers:
+            self._tasks.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._results.put(None)
+        self._collector.join()
+        self._workers = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,177 @@
+"""
+Lightweight instrumentation of the tree pipeline. Stages (e.g. `prepare_inputs` or each decoder layer) are timed with
+`stage` and events are counted with `count`; both only record anything while a `Profiler` is active:
+
+    with Profiler() as profiler:
+        tokens, positions, attention_mask, _ = multitext.prepare_inputs()
+        model(...)
+    print(profiler.summary())
+
+When no profiler is active, `stage` returns a shared no-op context manager and `count` returns immediately.
+"""
+import os
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+_active: Optional["Profiler"] = None
+
+
+@dataclass
+class StageStats:
+    nr_calls: int = 0
+    wall_time: float = 0.  # in seconds, summed over the calls
+    nr_tokens: int = 0  # summed over the calls
+    # the largest increase (in bytes) of the resident set size of the process during a call over its size at the start
+    # of the call, sampled by the profiler; 0 on platforms without procfs
+    peak_rss: int = 0
+
+
+def current_rss() -> Optional[int]:
+    """
+    :return: the resident set size of the process in bytes, or None on platforms without procfs.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return None
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+    def add_tokens(self, nr_tokens: int):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    def __init__(self, profiler: "Profiler", name: str, nr_tokens: int):
+        self.profiler = profiler
+        self.name = name
+        self.nr_tokens = nr_tokens
+
+    def __enter__(self):
+        self.start_rss = self.peak_rss = current_rss()
+        self.profiler._open_stages.add(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        wall_time = time.perf_counter() - self.start
+        self.profiler._open_stages.discard(self)
+        increase = max(self.peak_rss, current_rss()) - self.start_rss if self.start_rss is not None else 0
+        self.profiler.record(self.name, wall_time, self.nr_tokens, increase)
+        return False
+
+    def add_tokens(self, nr_tokens: int):
+        self.nr_tokens += nr_tokens
+
+
+def stage(name: str, nr_tokens: int = 0, index: Optional[int] = None):
+    """
+    Times the enclosed code as a stage of the active profiler, if any.
+    :param name: the name of the stage.
+    :param nr_tokens: the number of tokens processed, more can be added with `add_tokens` on the returned object.
+    :param index: if passed, it is appended to the name (e.g. the index of a layer).
+    """
+    if _active is None:
+        return _NULL_STAGE
+    return _Stage(_active, name if index is None else f'{name}.{index}', nr_tokens)
+
+
+def count(name: str, value: int = 1):
+    """
+    Increments a counter of the active profiler, if any.
+    """
+    if _active is None:
+        return
+    _active.counters[name] += value
+
+
+class Profiler:
+    """
+    Collects the statistics of the stages and counters while it is active (as a context manager). Profilers can be
+    nested, in which case only the innermost one records. While active, a background thread samples the resident set
+    size of the process to find the peak of each open stage, like `benchmark.PeakMemory`.
+    """
+
+    def __init__(self, callback: Optional[Callable[[str, float, int], None]] = None, memory_interval: float = 0.001):
+        """
+        :param callback: called at the end of each stage with its name, wall time and number of tokens.
+        :param memory_interval: the interval (in seconds) at which the resident set size is sampled.
+        """
+        self.callback = callback
+        self.memory_interval = memory_interval
+        self.stages: dict[str, StageStats] = {}
+        self.counters: Counter[str] = Counter()
+        self._previous = None
+        self._open_stages: set[_Stage] = set()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        while not self._stop.is_set():
+            rss = current_rss()
+            for s in list(self._open_stages):
+                s.peak_rss = max(s.peak_rss, rss)
+            self._stop.wait(self.memory_interval)
+
+    def __enter__(self):
+        global _active
+        self._previous, _active = _active, self
+        if current_rss() is not None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        global _active
+        _active = self._previous
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        return False
+
+    def record(self, name: str, wall_time: float, nr_tokens: int, peak_rss: int = 0):
+        """
+        Adds a call of a stage to its statistics.
+        :param peak_rss: the peak increase in the resident set size of the process during the call, in bytes.
+        """
+        stats = self.stages.setdefault(name, StageStats())
+        stats.nr_calls += 1
+        stats.wall_time += wall_time
+        stats.nr_tokens += nr_tokens
+        stats.peak_rss = max(stats.peak_rss, peak_rss)
+        if self.callback is not None:
+            self.callback(name, wall_time, nr_tokens)
+
+    def as_dict(self) -> dict:
+        return dict(
+            stages={name: vars(stats).copy() for name, stats in self.stages.items()},
+            counters=dict(self.counters),
+        )
+
+    def summary(self) -> str:
+        """
+        :return: a table of the stages (slowest first) and the counters.
+        """
+        lines = [f'{"stage":<32} {"calls":>8} {"time (s)":>10} {"tokens":>10} {"tokens/s":>12} {"peak RSS +(MiB)":>16}']
+        for name, stats in sorted(self.stages.items(), key=lambda x: x[1].wall_time, reverse=True):
+            throughput = stats.nr_tokens / stats.wall_time if stats.wall_time > 0 else 0.
+            lines.append(f'{name:<32} {stats.nr_calls:>8} {stats.wall_time:>10.4f} {stats.nr_tokens:>10} '
+                         f'{throughput:>12.1f} {stats.peak_rss / 2 ** 20:>16.1f}')
+        for name, value in sorted(self.counters.items()):
+            lines.append(f'{name:<32} {value:>8}')
+        return '\n'.join(lines)
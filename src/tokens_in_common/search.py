@@ -0,0 +1,192 @@
+from dataclasses import dataclass
+from typing import Optional
+
+import torch
+
+from tokens_in_common.modeling.llama import LlamaForCausalLM
+from tokens_in_common.modeling.tree_cache import TreeKVCache
+from tokens_in_common.multitext import MultiText, VertexID
+from tokens_in_common.utils import Reference
+
+
+@torch.no_grad()
+def tree_beam_search(
+        model: LlamaForCausalLM, multitext: MultiText[list[int]], nr_steps: int, beam_width: int = 4, top_k: int = 2,
+        eos_token_id: Optional[int] = None, length_normalize: bool = False,
+        pos_method: MultiText.PositioningMethod = MultiText.PositioningMethod.FULL_ALIGNMENT
+) -> tuple[MultiText[list[int]], dict[VertexID, float]]:
+    """
+    Explores continuations of the leaves of a tokenized MultiText. In each step, the `beam_width` best leaves are
+    expanded with their `top_k` most likely next tokens, which are added to the MultiText as child vertices. Only the
+    new tokens are forwarded, attending to the cached keys and values of the tree, so shared history is computed once.
+    The leaves are ranked by the log-probability of their whole leaf ancestry, including the tokens of the initial
+    MultiText, such that initial and generated leaves are compared alike. Leaves that are not among the best remain
+    candidates for expansion in later steps.
+    :param model: the model to forward.
+    :param multitext: the tokenized MultiText whose leaves are continued; it is copied, not modified.
+    :param nr_steps: how many times to expand the best leaves.
+    :param beam_width: how many leaves to expand per step.
+    :param top_k: how many children (next tokens) to add to each expanded leaf.
+    :param eos_token_id: if passed, leaves ending with this token are not expanded.
+    :param length_normalize: whether to rank the leaves by their mean instead of their total log-probability. The first
+    token of the MultiText is not scored.
+    :param pos_method: how to assign the tokens of the initial MultiText their position_ids.
+    :return: the MultiText including the explored continuations, and the log-probability of the generated tokens on
+    the path to each generated vertex.
+    """
+    multitext = multitext.copy(None)
+    cache = TreeKVCache(model)
+
+    tokens, positions, attention_mask, _, index_maps = multitext.prepare_inputs(
+        pos_method=pos_method, return_index_maps=True
+    )
+    logits = cache.extend_with_mask(tokens, torch.BoolTensor(attention_mask), positions).logits[0]
+
+    leaves = [v for v in multitext.vertices if len(v.children) == 0]
+    last_token = {id(v): int(i) for v, i in zip(leaves, index_maps.leaf_last_token)}
+    log_probs = logits.float().log_softmax(dim=-1)
+    next_log_probs = {id(v): log_probs[last_token[id(v)]] for v in leaves}
+
+    # the initial leaves start with the log-probability of their ancestry, which is subtracted again from the returned
+    # scores of the generated vertices
+    input_ids = torch.LongTensor(tokens)
+    scores, lengths, initial_scores = {}, {}, {}
+    for v, path, length in zip(leaves, index_maps.path_token_indices, index_maps.path_lengths):
+        path = torch.from_numpy(path[:length])
+        scores[id(v)] = initial_scores[id(v)] = log_probs[path[:-1], input_ids[path[1:]]].sum().item()
+        lengths[id(v)] = max(int(length) - 1, 0)
+
+    def rank(v):
+        return scores[id(v)] / lengths[id(v)] if length_normalize and lengths[id(v)] > 0 else scores[id(v)]
+
+    frontier = list(leaves)
+    for _ in range(nr_steps):
+        candidates = [v for v in frontier if eos_token_id is None or v.component.value[-1:] != [eos_token_id]]
+        expand = sorted(candidates, key=rank, reverse=True)[:beam_width]
+        if not expand:
+            break
+
+        new_vertices, new_tokens, predecessors = [], [], []
+        for leaf in expand:
+            top_log_probs, top_tokens = next_log_probs.pop(id(leaf)).topk(top_k)
+            for log_prob, token in zip(top_log_probs.tolist(), top_tokens.tolist()):
+                child = multitext.add_vertex(Reference([token]), leaf.position + 1, parents=[leaf])
+                scores[id(child)] = scores[id(leaf)] + log_prob
+                lengths[id(child)] = lengths[id(leaf)] + 1
+                initial_scores[id(child)] = initial_scores[id(leaf)]
+                new_vertices.append(child)
+                new_tokens.append(token)
+                predecessors.append(last_token[id(leaf)])
+            frontier.remove(leaf)
+
+        nr_cached = len(cache)
+        logits = cache.extend(torch.LongTensor(new_tokens), torch.LongTensor(predecessors)).logits[0]
+        for j, child in enumerate(new_vertices):
+            last_token[id(child)] = nr_cached + j
+            next_log_probs[id(child)] = logits[j].float().log_softmax(dim=-1)
+        frontier.extend(new_vertices)
+
+    generated = {id(v) for v in multitext.vertices} - {id(v) for v in leaves}
+    return multitext, {
+        vertex_id: score - initial_scores[vertex_id] for vertex_id, score in scores.items() if vertex_id in generated
+    }
+
+
+@dataclass
+class RankingResult:
+    top: list[tuple[MultiText.Vertex, float]]  # the best leaves and their scores, best first
+    nr_tokens_forwarded: int
+    nr_tokens_total: int
+
+
+@dataclass
+class _Branch:
+    vertex: MultiText.Vertex
+    offset: int  # index of the next token of the vertex to forward
+    score: float  # log-probability of the tokens up to and including the next token
+    predecessor: int  # cache index of the last forwarded token on this branch, -1 for none
+
+
+@torch.no_grad()
+def rank_options(
+        model: LlamaForCausalLM, multitext: MultiText[list[int]], k: int = 1, chunk_size: int = 8,
+        max_frontier: Optional[int] = None
+) -> RankingResult:
+    """
+    Finds the `k` leaf ancestries of a tokenized tree with the highest log-probability, using branch-and-bound. The
+    tree is forwarded in chunks of at most `chunk_size` tokens per branch, under a shared tree key/value cache. Since
+    log-probabilities are non-positive, the partial score of a branch bounds the score of any leaf below it, so a branch
+    is dropped as soon as its partial score falls below the k-th best score of the completed leaves, and its remaining
+    tokens are never forwarded.
+    The tokens are assigned position_ids like `PositioningMethod.NO_ALIGNMENT`. The first token of a root has no
+    predecessor, and is not scored.
+    :param model: the model to forward.
+    :param multitext: a tokenized MultiText in which each vertex has at most one parent.
+    :param k: the number of leaves to find.
+    :param chunk_size: the maximum number of tokens to forward per branch at a time.
+    :param max_frontier: the maximum number of branches to forward at a time, those with the best partial score first.
+    Defaults to all branches, i.e. level by level.
+    """
+    if any(len(v.parents) > 1 for v in multitext.vertices):
+        raise ValueError("Ranking options requires a MultiText in which each vertex has at most one parent.")
+
+    cache = TreeKVCache(model)
+    completed: list[tuple[MultiText.Vertex, float]] = []
+
+    def enter(vertex, score, predecessor, log_probs):
+        # the branches that start at this vertex, given the log-probabilities predicted by its predecessor
+        if len(vertex.component.value) == 0:
+            if len(vertex.children) == 0:
+                completed.append((vertex, score))
+                return []
+            return [b for child in vertex.children for b in enter(child, score, predecessor, log_probs)]
+        if log_probs is not None:
+            score += log_probs[vertex.component.value[0]].item()
+        return [_Branch(vertex, 0, score, predecessor)]
+
+    frontier = [b for v in multitext.vertices if len(v.parents) == 0 for b in enter(v, 0., -1, None)]
+    while frontier:
+        # drop the branches that cannot reach the top-k anymore
+        if len(completed) >= k:
+            bound = sorted((score for _, score in completed), reverse=True)[k - 1]
+            frontier = [b for b in frontier if b.score >= bound]
+        frontier.sort(key=lambda b: b.score, reverse=True)
+        selected = frontier[:max_frontier] if max_frontier is not None else frontier
+        frontier = frontier[len(selected):]
+        if not selected:
+            break
+
+        # forward the next chunk of each selected branch
+        nr_cached = len(cache)
+        new_tokens, predecessors, chunks = [], [], []
+        for branch in selected:
+            chunk = branch.vertex.component.value[branch.offset:branch.offset + chunk_size]
+            chunks.append((nr_cached + len(new_tokens), len(chunk)))
+            for j, token in enumerate(chunk):
+                predecessors.append(branch.predecessor if j == 0 else nr_cached + len(new_tokens) - 1)
+                new_tokens.append(token)
+        log_probs = cache.extend(torch.LongTensor(new_tokens), torch.LongTensor(predecessors)).logits[0]
+        log_probs = log_probs.float().log_softmax(dim=-1)
+
+        for branch, (start, length) in zip(selected, chunks):
+            tokens = branch.vertex.component.value
+            offset = branch.offset + length
+            # the logits of each forwarded token predict the next token of the vertex
+            branch.score += sum(
+                log_probs[start - nr_cached + j, tokens[branch.offset + j + 1]].item() for j in range(length - 1)
+            )
+            last = start + length - 1
+            if offset < len(tokens):
+                score = branch.score + log_probs[last - nr_cached, tokens[offset]].item()
+                frontier.append(_Branch(branch.vertex, offset, score, last))
+            elif len(branch.vertex.children) > 0:
+                for child in branch.vertex.children:
+                    frontier.extend(enter(child, branch.score, last, log_probs[last - nr_cached]))
+            else:
+                completed.append((branch.vertex, branch.score))
+
+    return RankingResult(
+        top=sorted(completed, key=lambda x: x[1], reverse=True)[:k],
+        nr_tokens_forwarded=len(cache),
+        nr_tokens_total=sum(len(v.component.value) for v in multitext.vertices),
+    )
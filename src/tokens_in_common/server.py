@@ -0,0 +1,252 @@
+"""
+A local asyncio inference server that packs concurrent requests into a single tree-masked forward.
+
+Requests are HTTP POSTs with a JSON body that describes a MultiText, either as option strings:
+    {"option_strings": ["The sentence is ", ["true.", "false."]], "mode": "STANDARD", "outputs": ["scores"]}
+or as vertex elements and parent indices (see `MultiText.from_vertex_elements`):
+    {"vertices": [["The sentence is ", 0], ["true.", 1], ["false.", 1]], "parents": [[], [0], [0]]}
+The response contains an entry for each leaf ancestry (in the order of `MultiText.get_leaf_ancestries`), with its text
+and the requested outputs: "scores" (the log-likelihood of its tokens) and/or "hidden_states" (the final hidden state
+of its last token).
+
+Run with `python -m tokens_in_common.server --help`.
+"""
+import argparse
+import asyncio
+import json
+import time
+from dataclasses import dataclass
+from typing import Callable, Optional, Union
+
+import torch
+from tokenizers import Encoding
+
+from tokens_in_common.data import OptionStringBuildMode, multitext_from_option_strings
+from tokens_in_common.modeling.gather import gather_leaves, gather_paths
+from tokens_in_common.modeling.llama import LlamaForCausalLM, LlamaModel
+from tokens_in_common.multitext import MultiText
+from tokens_in_common.tokenization import tokenize_multitext
+from tokens_in_common.utils import Reference
+
+OUTPUTS = ('scores', 'hidden_states')
+
+
+@dataclass
+class _Request:
+    multitext: MultiText[str]
+    tok_multitext: MultiText[list[int]]
+    outputs: tuple[str]
+    future: asyncio.Future
+
+    @property
+    def nr_tokens(self):
+        return sum(len(v.component.value) for v in self.tok_multitext.vertices)
+
+
+def multitext_from_json(request: dict) -> MultiText[str]:
+    """
+    :param request: a request body as described in the module's docstring.
+    """
+    if 'option_strings' in request:
+        mode = OptionStringBuildMode[request.get('mode', 'STANDARD')]
+        text = [part if isinstance(part, str) else tuple(part) for part in request['option_strings']]
+        return multitext_from_option_strings(mode, text)
+    elif 'vertices' in request:
+        elements = [(Reference(text), position) for text, position in request['vertices']]
+        return MultiText.from_vertex_elements(elements, request['parents'])
+    raise ValueError("A request must contain either 'option_strings' or 'vertices' and 'parents'.")
+
+
+class TreeBatchingServer:
+    """
+    Collects the MultiTexts that are submitted within a short latency window, and forwards them together as a single
+    tree-masked forward, after which each caller receives the outputs of its own leaf ancestries.
+    """
+
+    def __init__(
+            self, model: Union[LlamaModel, LlamaForCausalLM], tokenize_fn: Callable[[str], Encoding],
+            max_latency: float = 0.01, max_batch_tokens: int = 4096,
+            pos_method: MultiText.PositioningMethod = MultiText.PositioningMethod.FULL_ALIGNMENT
+    ):
+        """
+        :param model: the model to forward; scores can only be computed by a `LlamaForCausalLM`.
+        :param tokenize_fn: the tokenizer, see `tokenize_multitext`.
+        :param max_latency: how long (in seconds) to wait for more requests after receiving the first of a batch.
+        :param max_batch_tokens: no more requests are added to a batch once it has at least this many tokens.
+        :param pos_method: how to assign the tokens their position_ids.
+        """
+        self.model = model.eval()
+        self.tokenize_fn = tokenize_fn
+        self.max_latency = max_latency
+        self.max_batch_tokens = max_batch_tokens
+        self.pos_method = pos_method
+        self.nr_forwards = 0
+
+        self._queue: Optional[asyncio.Queue] = None
+        self._batcher: Optional[asyncio.Task] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def submit(self, multitext: MultiText[str], outputs=('scores',)) -> list[dict]:
+        """
+        Submits a MultiText to be forwarded with the next batch.
+        :param outputs: which outputs to return for each leaf ancestry (see `OUTPUTS`).
+        :return: a dictionary with the text and outputs of each leaf ancestry.
+        """
+        outputs = tuple(outputs)
+        if any(o not in OUTPUTS for o in outputs):
+            raise ValueError(f"Unknown outputs {outputs}, expected a subset of {OUTPUTS}.")
+        if 'scores' in outputs and not isinstance(self.model, LlamaForCausalLM):
+            raise ValueError("Scores can only be computed with a `LlamaForCausalLM`.")
+        positions = {v.position for v in multitext.vertices}
+        if positions != set(range(len(positions))):
+            # checked here, as it would otherwise fail the forward of the whole batch
+            raise ValueError(f"The vertex positions must be contiguous from 0, got {sorted(positions)}.")
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._batcher = asyncio.create_task(self._run_batches())
+
+        tok_multitext = tokenize_multitext(multitext, self.tokenize_fn)
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(_Request(multitext, tok_multitext, outputs, future))
+        return await future
+
+    async def _run_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = time.monotonic() + self.max_latency
+            while sum(r.nr_tokens for r in batch) < self.max_batch_tokens:
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), deadline - time.monotonic()))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                results = await loop.run_in_executor(None, self._forward, batch)
+            except Exception as e:
+                if len(batch) == 1:
+                    batch[0].future.set_exception(e)
+                    continue
+                # retry the requests one by one, so that only the request that caused the error receives it
+                for request in batch:
+                    try:
+                        result, = await loop.run_in_executor(None, self._forward, [request])
+                    except Exception as e:
+                        request.future.set_exception(e)
+                    else:
+                        request.future.set_result(result)
+            else:
+                for request, result in zip(batch, results):
+                    request.future.set_result(result)
+
+    @torch.no_grad()
+    def _forward(self, batch: list[_Request]) -> list[list[dict]]:
+        combined = sum((r.tok_multitext for r in batch[1:]), start=batch[0].tok_multitext)
+        tokens, positions, attention_mask, _, index_maps = combined.prepare_inputs(
+            pos_method=self.pos_method, return_index_maps=True
+        )
+        base_model = self.model.model if isinstance(self.model, LlamaForCausalLM) else self.model
+        hidden_states = base_model(
+            input_ids=torch.LongTensor([tokens]),
+            position_ids=torch.LongTensor([positions]),
+            attention_mask=torch.LongTensor(attention_mask)[None, None],
+            use_cache=False,
+        ).last_hidden_state[0]
+        self.nr_forwards += 1
+
+        outputs = {}
+        if any('hidden_states' in r.outputs for r in batch):
+            outputs['hidden_states'] = gather_leaves(hidden_states, index_maps).tolist()
+        if any('scores' in r.outputs for r in batch):
+            # the log-likelihood of each token given its predecessor, summed over the leaf ancestries
+            log_probs = self.model.lm_head(hidden_states).float().log_softmax(dim=-1)
+            predecessors = torch.as_tensor(index_maps.token_predecessors)
+            token_log_probs = log_probs[predecessors.clamp(min=0), torch.LongTensor(tokens)]
+            token_log_probs = token_log_probs.masked_fill(predecessors < 0, 0.)
+            outputs['scores'] = gather_paths(token_log_probs.unsqueeze(-1), index_maps)[0].sum(dim=(1, 2)).tolist()
+
+        # the leaf ancestries of the combined MultiText are those of each request, in order
+        results, offset = [], 0
+        for request in batch:
+            leaf_texts = [
+                "".join(v.component.value for v in ancestry) for ancestry in request.multitext.get_leaf_ancestries()
+            ]
+            results.append([
+                dict(text=text, **{o: outputs[o][offset + i] for o in request.outputs})
+                for i, text in enumerate(leaf_texts)
+            ])
+            offset += len(leaf_texts)
+        return results
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0, path: Optional[str] = None):
+        """
+        Starts serving HTTP requests on a TCP port, or on a unix socket if `path` is passed.
+        :return: the address that is served on.
+        """
+        if path is not None:
+            self._server = await asyncio.start_unix_server(self._handle, path=path)
+        else:
+            self._server = await asyncio.start_server(self._handle, host=host, port=port)
+        return self._server.sockets[0].getsockname()
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        if self._batcher is not None:
+            self._batcher.cancel()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            await reader.readline()  # the request line
+            content_length = 0
+            while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                name, _, value = line.decode('latin-1').partition(':')
+                if name.strip().lower() == 'content-length':
+                    content_length = int(value.strip())
+            body = json.loads(await reader.readexactly(content_length))
+
+            multitext = multitext_from_json(body)
+            leaves = await self.submit(multitext, outputs=body.get('outputs', ('scores',)))
+            status, response = '200 OK', dict(leaves=leaves)
+        except (ValueError, KeyError, TypeError) as e:
+            status, response = '400 Bad Request', dict(error=str(e))
+        except Exception as e:
+            status, response = '500 Internal Server Error', dict(error=str(e))
+
+        payload = json.dumps(response).encode()
+        writer.write(
+            f'HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(payload)}\r\n'
+            f'Connection: close\r\n\r\n'.encode() + payload
+        )
+        await writer.drain()
+        writer.close()
+
+
+async def _serve(args):
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    model = LlamaForCausalLM.from_pretrained(args.model)
+    server = TreeBatchingServer(
+        model, lambda x: tokenizer(x).encodings[0], max_latency=args.max_latency,
+        max_batch_tokens=args.max_batch_tokens,
+    )
+    address = await server.start(host=args.host, port=args.port, path=args.path)
+    print(f'Serving on {address}')
+    await asyncio.Event().wait()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', required=True, help='name or path of a pretrained Llama model and tokenizer')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--path', help='serve on this unix socket instead of on a TCP port')
+    parser.add_argument('--max-latency', type=float, default=0.01)
+    parser.add_argument('--max-batch-tokens', type=int, default=4096)
+    asyncio.run(_serve(parser.parse_args(args)))
+
+
+if __name__ == '__main__':
+    main()
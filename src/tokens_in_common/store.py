@@ -0,0 +1,195 @@
+"""
+An append-only store of fixed-shape results (e.g. the hidden states of each layer, or a score) keyed by a stable
+ancestral hash (see `MultiText.Vertex.calc_stable_ancestral_hash`).
+
+A store is a directory with a `meta.json` that describes the shape and dtype of the results, and chunk files that are
+written by one writer each, so that many processes can write to the same store without coordination:
+    <writer_id>.<chunk>.values  the results, as raw records
+    <writer_id>.<chunk>.keys    the key of each result, written after its result
+The chunk files are memory-mapped for reading, so results can be accessed randomly without loading the store.
+"""
+import json
+import os
+import uuid
+from pathlib import Path
+from typing import Iterable, Optional, Sequence, Union
+
+import numpy as np
+
+KEY_SIZE = 16
+
+
+class ResultWriter:
+    """
+    Appends results to chunk files of a `ResultStore`, starting a new chunk every `chunk_size` results.
+    """
+
+    def __init__(self, path: Path, writer_id: str, shape: tuple[int, ...], dtype: np.dtype, chunk_size: int):
+        self.path = path
+        self.writer_id = writer_id
+        self.shape = shape
+        self.dtype = dtype
+        self.chunk_size = chunk_size
+
+        self._chunk = -1
+        self._nr_in_chunk = chunk_size
+        self._keys_file = None
+        self._values_file = None
+
+    def _next_chunk(self):
+        self._close_files()
+        self._chunk += 1
+        while (self.path / f'{self.writer_id}.{self._chunk:06d}.keys').exists():
+            self._chunk += 1
+        name = f'{self.writer_id}.{self._chunk:06d}'
+        self._values_file = open(self.path / f'{name}.values', 'ab')
+        self._keys_file = open(self.path / f'{name}.keys', 'ab')
+        self._nr_in_chunk = 0
+
+    def append(self, key: bytes, value):
+        """
+        :param key: a key of `KEY_SIZE` bytes.
+        :param value: an array of the store's shape.
+        """
+        if len(key) != KEY_SIZE:
+            raise ValueError(f"Keys must be {KEY_SIZE} bytes, not {len(key)}.")
+        value = np.asarray(value, dtype=self.dtype)
+        if value.shape != self.shape:
+            raise ValueError(f"Expected a result of shape {self.shape}, not {value.shape}.")
+        if self._nr_in_chunk >= self.chunk_size:
+            self._next_chunk()
+        # the key is written last, so only complete results are read
+        self._values_file.write(value.tobytes())
+        self._keys_file.write(key)
+        self._nr_in_chunk += 1
+
+    def extend(self, keys: Iterable[bytes], values: Iterable):
+        for key, value in zip(keys, values):
+            self.append(key, value)
+
+    def flush(self):
+        if self._values_file is not None:
+            self._values_file.flush()
+            self._keys_file.flush()
+
+    def _close_files(self):
+        if self._values_file is not None:
+            self._values_file.close()
+            self._keys_file.close()
+
+    def close(self):
+        self._close_files()
+        self._values_file = self._keys_file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class ResultStore:
+    """
+    Reads (and creates writers for) a store of results, see the module's docstring. Results that are written after the
+    store is opened become visible after calling `refresh`.
+    """
+
+    def __init__(
+            self, path: Union[str, os.PathLike], shape: Optional[Sequence[int]] = None, dtype=None,
+            chunk_size: int = 65536
+    ):
+        """
+        :param path: the directory of the store, which is created if it does not exist.
+        :param shape: the shape of each result, required to create a store (e.g. `(nr_layers, hidden_size)` or `()`).
+        :param dtype: the dtype of the results, required to create a store.
+        :param chunk_size: the number of results per chunk file of the writers.
+        """
+        self.path = Path(path)
+        self.chunk_size = chunk_size
+        meta_path = self.path / 'meta.json'
+        if meta_path.exists():
+            meta = json.loads(meta_path.read_text())
+            self.shape, self.dtype = tuple(meta['shape']), np.dtype(meta['dtype'])
+            if (shape is not None and tuple(shape) != self.shape) \
+                    or (dtype is not None and np.dtype(dtype) != self.dtype):
+                raise ValueError(f"The store at {path} holds results of shape {self.shape} and dtype {self.dtype}.")
+        else:
+            if shape is None or dtype is None:
+                raise ValueError("The shape and dtype of the results are required to create a store.")
+            self.shape, self.dtype = tuple(shape), np.dtype(dtype)
+            self.path.mkdir(parents=True, exist_ok=True)
+            # write the metadata atomically, as other processes may create the same store concurrently
+            tmp_path = self.path / f'meta.json.{uuid.uuid4().hex}'
+            tmp_path.write_text(json.dumps(dict(shape=self.shape, dtype=self.dtype.str)))
+            os.replace(tmp_path, meta_path)
+
+        self._values: list[np.memmap] = []
+        self._keys = np.zeros((0, KEY_SIZE), dtype=np.uint8)
+        self._locations = np.zeros((0, 2), dtype=np.int64)  # the chunk and row of each key
+        self._order = np.zeros(0, dtype=np.int64)
+        self._sorted_prefixes = np.zeros(0, dtype=np.uint64)
+        self.refresh()
+
+    def writer(self, writer_id: Optional[str] = None) -> ResultWriter:
+        """
+        :param writer_id: a name that is unique among the writers of the store, defaults to a random one.
+        """
+        writer_id = writer_id if writer_id is not None else f'{os.getpid()}-{uuid.uuid4().hex[:12]}'
+        return ResultWriter(self.path, writer_id, self.shape, self.dtype, self.chunk_size)
+
+    def refresh(self):
+        """
+        Memory-maps the chunk files, including the results written since the last refresh.
+        """
+        record_size = self.dtype.itemsize * int(np.prod(self.shape, dtype=np.int64))
+        values, keys, locations = [], [], []
+        for keys_path in sorted(self.path.glob('*.keys')):
+            values_path = keys_path.with_suffix('.values')
+            nr_results = min(keys_path.stat().st_size // KEY_SIZE, values_path.stat().st_size // max(record_size, 1))
+            if nr_results == 0:
+                continue
+            keys.append(np.fromfile(keys_path, dtype=np.uint8, count=nr_results * KEY_SIZE).reshape(-1, KEY_SIZE))
+            values.append(np.memmap(values_path, dtype=self.dtype, mode='r', shape=(nr_results, *self.shape)))
+            locations.append(np.stack([np.full(nr_results, len(values) - 1), np.arange(nr_results)], axis=1))
+
+        self._values = values
+        self._keys = np.concatenate(keys) if keys else np.zeros((0, KEY_SIZE), dtype=np.uint8)
+        self._locations = np.concatenate(locations) if locations else np.zeros((0, 2), dtype=np.int64)
+        # index the keys by their first 8 bytes
+        prefixes = self._keys[:, :8].copy().view('<u8')[:, 0]
+        self._order = np.argsort(prefixes, kind='stable')
+        self._sorted_prefixes = prefixes[self._order]
+
+    def _find(self, key: bytes) -> Optional[int]:
+        if len(key) != KEY_SIZE:
+            return None
+        key = np.frombuffer(key, dtype=np.uint8)
+        prefix = key[:8].view('<u8')[0]
+        start = np.searchsorted(self._sorted_prefixes, prefix, side='left')
+        end = np.searchsorted(self._sorted_prefixes, prefix, side='right')
+        for i in self._order[start:end]:
+            if (self._keys[i] == key).all():
+                return i
+        return None
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key: bytes):
+        return self._find(key) is not None
+
+    def __getitem__(self, key: bytes) -> np.ndarray:
+        """
+        :return: a read-only, memory-mapped view of the result.
+        """
+        i = self._find(key)
+        if i is None:
+            raise KeyError(key)
+        chunk, row = self._locations[i]
+        return self._values[chunk][row]
+
+    def get(self, key: bytes, default=None):
+        return self[key] if key in self else default
+
+    def keys(self) -> Iterable[bytes]:
+        return (key.tobytes() for key in self._keys)
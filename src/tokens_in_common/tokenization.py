@@ -4,6 +4,7 @@ from typing import Callable
 from tokenizers import Encoding
 
 from tokens_in_common.multitext import MultiText
+from tokens_in_common.profiling import stage
 from tokens_in_common.utils import Reference
 
 
@@ -13,7 +14,15 @@ def tokenize_multitext(multitext: MultiText[str], tokenize_fn: Callable[[str], E
     :param tokenize_fn:
     :return:
     """
+    with stage('tokenize_multitext') as s:
+        result = _tokenize_multitext(multitext, tokenize_fn)
+        s.add_tokens(sum(len(v.component.value) for v in result.vertices))
+    return result
+
+
+def _tokenize_multitext(multitext: MultiText[str], tokenize_fn: Callable[[str], Encoding]) -> MultiText[list[int]]:
     leaf_ancestries = list(multitext.get_leaf_ancestries())
+    is_forest = multitext.is_forest()
     vertex_id_positions = {id(v): v.position for v in multitext.vertices}
 
     successor_dict = {
@@ -30,9 +39,7 @@ def tokenize_multitext(multitext: MultiText[str], tokenize_fn: Callable[[str], E
         full_string = "".join(v.component.value for v in vertices)
 
         # keep track of original string references that each character came from
-        char_vertices = sum(
-            ([v] * len(v.component.value) for v in vertices), start=[]
-        )
+        char_vertices = [v for v in vertices for _ in range(len(v.component.value))]
 
         # tokenize joined string
         encoding = tokenize_fn(full_string)
@@ -67,7 +74,13 @@ def tokenize_multitext(multitext: MultiText[str], tokenize_fn: Callable[[str], E
                     token_vertices_s = sorted(token_vertices.values(), key=lambda x: x.position)
 
                     # check the connectivity of the vertices contributing to this token
-                    connected = [True] + [w in v.children for v, w in itertools.pairwise(token_vertices_s)]
+                    if is_forest:
+                        # in a forest, only the single parent needs to be checked
+                        connected = [True] + [w.parents[0] is v for v, w in itertools.pairwise(token_vertices_s)]
+                    else:
+                        connected = [True] + [
+                            any(c is w for c in v.children) for v, w in itertools.pairwise(token_vertices_s)
+                        ]
                     cutoff = ([i for i, t in enumerate(connected) if not t] + [len(connected)])[0]
 
                     # if there is a discontinuity, assert that the nr. of siblings post discontinuity is always 1
@@ -24,3 +24,14 @@ def list_find(lst, sub_lst):
             return i
     raise ValueError
 
+
+def longest_common_prefix(sequences):
+    """
+    :param sequences: A non-empty list of sliceable sequences (e.g. strings or lists).
+    :return: The longest prefix that all sequences have in common, of the same type as the sequences.
+    """
+    shortest = min(sequences, key=len)
+    for i, element in enumerate(shortest):
+        if any(seq[i] != element for seq in sequences):
+            return shortest[:i]
+    return shortest
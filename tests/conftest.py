@@ -0,0 +1,42 @@
+import pytest
+import torch
+
+from tokens_in_common.benchmark import tiny_llama_config
+from tokens_in_common.data import OptionStringBuildMode, multitext_from_option_strings
+from tokens_in_common.modeling.llama import LlamaModel
+from tokens_in_common.multitext import MultiText
+from tokens_in_common.utils import Reference
+
+
+@pytest.fixture
+def sample():
+    return ['The sentence "Four children are playing in some water." is ', ('true.', 'false.'),
+            'The sentence "The children are wet." is ', ('true.', 'false.', 'unknown.')]
+
+
+@pytest.fixture
+def tiny_model():
+    torch.manual_seed(0)
+    return LlamaModel(tiny_llama_config(vocab_size=128, num_hidden_layers=3)).eval()
+
+
+@pytest.fixture
+def tree_multitext(sample):
+    multitext = multitext_from_option_strings(OptionStringBuildMode.STANDARD, sample)
+    # use the characters' code points as token ids
+    return multitext.copy({id(v): Reference([ord(c) for c in v.component.value]) for v in multitext.vertices})
+
+
+@pytest.fixture
+def tree_inputs(tree_multitext):
+    def prepare(pos_method=MultiText.PositioningMethod.FULL_ALIGNMENT):
+        tokens, positions, attention_mask, _, index_maps = tree_multitext.prepare_inputs(
+            pos_method=pos_method, return_index_maps=True
+        )
+        inputs = dict(
+            input_ids=torch.LongTensor([tokens]),
+            position_ids=torch.LongTensor([positions]),
+            attention_mask=torch.LongTensor(attention_mask)[None, None],
+        )
+        return inputs, index_maps
+    return prepare
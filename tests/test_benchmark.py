@@ -0,0 +1,16 @@
+from tokens_in_common.benchmark import run_benchmark, STAGES, synthetic_option_strings
+from tokens_in_common.data import OptionStringBuildMode
+
+
+def test_synthetic_option_strings():
+    text = synthetic_option_strings(depth=3, branching_factor=4, fragment_length=16)
+    assert len(text) == 6
+    assert all(isinstance(part, tuple) and len(part) == 4 for part in text[1::2])
+
+
+def test_run_benchmark_standard_full_equivalency():
+    for mode in [OptionStringBuildMode.STANDARD, OptionStringBuildMode.FULL]:
+        result = run_benchmark(depth=2, branching_factor=2, fragment_length=16, mode=mode, repeats=1)
+        assert set(result.stages.keys()) == set(STAGES)
+        assert result.nr_leaves == 4
+        assert result.max_abs_diff < 1e-4
@@ -0,0 +1,26 @@
+from tokens_in_common.caching import PreparedInputsCache
+from tokens_in_common.multitext import MultiText
+from tokens_in_common.utils import Reference
+
+
+def filled_template(premise, options):
+    elements = [(Reference(premise), 0)] + [(Reference(option), 1) for option in options]
+    return MultiText.from_vertex_elements(elements, [[]] + [[0]] * len(options))
+
+
+def test_prepared_inputs_cache():
+    cache = PreparedInputsCache(maxsize=2)
+    samples = [
+        filled_template([1, 2, 3], [[4, 5], [6]]),
+        filled_template([7, 8, 9], [[10, 11], [12]]),  # same shape, different tokens
+        filled_template([7, 8], [[10, 11], [12]]),
+    ]
+    for pos_method in MultiText.PositioningMethod:
+        for multitext in samples:
+            input_ids, position_ids, attention_mask, index_maps = cache.prepare_inputs(multitext, pos_method)
+            expected = multitext.prepare_inputs(pos_method=pos_method, return_index_maps=True)
+            assert (input_ids, position_ids, attention_mask) == (expected[0], expected[1], expected[2])
+            assert (index_maps.path_token_indices == expected[4].path_token_indices).all()
+
+    assert cache.hits == 2 and cache.misses == 4
+    assert len(cache) == 2
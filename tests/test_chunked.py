@@ -0,0 +1,30 @@
+import pytest
+import torch
+
+from tokens_in_common.data import OptionStringBuildMode, multitext_from_option_strings
+from tokens_in_common.modeling.chunked import chunked_prefill
+from tokens_in_common.multitext import MultiText
+from tokens_in_common.utils import Reference
+
+
+@torch.no_grad()
+def test_chunked_prefill(tiny_model, tree_inputs):
+    for pos_method in MultiText.PositioningMethod:
+        inputs, _ = tree_inputs(pos_method)
+        expected = tiny_model(**inputs, use_cache=False).last_hidden_state
+
+        for chunk_size in [1, 7, 64, 1024]:
+            hidden_states, cache = chunked_prefill(
+                tiny_model, inputs['input_ids'][0], inputs['position_ids'][0], inputs['attention_mask'][0, 0],
+                chunk_size
+            )
+            assert hidden_states.shape == expected.shape and len(cache) == expected.shape[1]
+            assert torch.allclose(hidden_states, expected, atol=1e-5)
+
+
+def test_chunked_prefill_requires_topological_order(tiny_model, sample):
+    multitext = multitext_from_option_strings(OptionStringBuildMode.FRUGAL, sample)
+    multitext = multitext.copy({id(v): Reference([ord(c) for c in v.component.value]) for v in multitext.vertices})
+    tokens, positions, attention_mask, _ = multitext.prepare_inputs()
+    with pytest.raises(ValueError):
+        chunked_prefill(tiny_model, tokens, positions, attention_mask)
@@ -0,0 +1,30 @@
+import torch
+
+from tokens_in_common.modeling.compiled import CompiledTreeForward
+from tokens_in_common.multitext import MultiText
+
+
+@torch.no_grad()
+def test_compiled_tree_forward(tiny_model, tree_inputs):
+    forward = CompiledTreeForward(tiny_model, buckets=(128, 512), backend='eager')
+
+    nr_tokens = 0
+    for pos_method in MultiText.PositioningMethod:
+        inputs, index_maps = tree_inputs(pos_method)
+        expected = tiny_model(**inputs, use_cache=False).last_hidden_state
+        input_ids, position_ids, attention_mask = inputs['input_ids'][0], inputs['position_ids'][0], \
+            inputs['attention_mask'][0, 0]
+
+        # the whole tree, and the ancestry of a single leaf
+        path = torch.as_tensor(index_maps.path_token_indices[0, :index_maps.path_lengths[0]])
+        outputs = forward(input_ids, position_ids, attention_mask)
+        path_outputs = forward(input_ids[path], position_ids[path], attention_mask[path][:, path])
+        assert torch.allclose(outputs, expected, atol=1e-5)
+        assert torch.allclose(path_outputs, expected[:, path], atol=1e-5)
+        nr_tokens += len(input_ids) + len(path)
+
+    assert 128 < len(input_ids) <= 512 and len(path) <= 128
+    assert forward.bucket_counts == {128: 2, 512: 2}
+    assert forward.nr_tokens == nr_tokens
+    assert forward.padding_fraction == 1 - nr_tokens / (2 * 128 + 2 * 512)
+    assert forward.bucket(1000) is None
@@ -0,0 +1,58 @@
+from tokenizers import Tokenizer, models, pre_tokenizers, trainers
+
+from tokens_in_common.data import multitext_from_texts
+from tokens_in_common.multitext import MultiText
+from tokens_in_common.utils import Reference
+
+TEST_TEXTS = [
+    'The sentence "The children are wet." is true.',
+    'The sentence "The children are wet." is false.',
+    'The sentence "The children are dry." is true.',
+]
+
+
+def test_multitext_from_texts_characters():
+    multitext, compression_ratio = multitext_from_texts(TEST_TEXTS)
+
+    # every leaf ancestry spells out exactly one of the texts
+    leaf_texts = ["".join(v.component.value for v in ancestry) for ancestry in multitext.get_leaf_ancestries()]
+    assert sorted(leaf_texts) == sorted(TEST_TEXTS)
+
+    # the shared prefix is stored only once
+    roots = [v for v in multitext.vertices if len(v.parents) == 0]
+    assert len(roots) == 1
+    assert roots[0].component.value == 'The sentence "The children are '
+
+    nr_merged = sum(len(v.component.value) for v in multitext.vertices)
+    assert compression_ratio == sum(len(text) for text in TEST_TEXTS) / nr_merged
+    assert compression_ratio > 1
+
+
+def test_multitext_from_texts_tokens():
+    tokenizer = Tokenizer(models.BPE(unk_token='<unk>'))
+    tokenizer.pre_tokenizer = pre_tokenizers.Metaspace()
+    trainer = trainers.BpeTrainer(vocab_size=100, special_tokens=['<unk>'], show_progress=False)
+    tokenizer.train_from_iterator(TEST_TEXTS, trainer)
+
+    multitext, compression_ratio = multitext_from_texts(TEST_TEXTS, tokenizer.encode)
+
+    leaf_ids = [sum((v.component.value for v in ancestry), start=[]) for ancestry in multitext.get_leaf_ancestries()]
+    assert sorted(leaf_ids) == sorted(tokenizer.encode(text).ids for text in TEST_TEXTS)
+    assert compression_ratio > 1
+
+
+def test_multitext_from_texts_prefix_and_duplicates():
+    multitext, compression_ratio = multitext_from_texts(['abc', 'abcde', 'abc', 'x'])
+
+    # the prefix 'abc' ends in an empty leaf, and its duplicate shares it
+    leaf_texts = ["".join(v.component.value for v in ancestry) for ancestry in multitext.get_leaf_ancestries()]
+    assert sorted(leaf_texts) == ['abc', 'abcde', 'x']
+    assert compression_ratio == 12 / 6
+
+    # each leaf ancestry, including the one ending in an empty vertex, ends at its own last token
+    tokenized = multitext.copy({id(v): Reference([ord(c) for c in v.component.value]) for v in multitext.vertices})
+    tokens, positions, _, _, index_maps = tokenized.prepare_inputs(
+        pos_method=MultiText.PositioningMethod.NO_ALIGNMENT, return_index_maps=True
+    )
+    assert len(tokens) == 6
+    assert sorted((chr(tokens[i]), positions[i]) for i in index_maps.leaf_last_token) == [('c', 2), ('e', 4), ('x', 0)]
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+import torch
+
+from tokens_in_common.distributed import partition_tree, run_distributed_forward
+from tokens_in_common.multitext import MultiText
+from tokens_in_common.utils import Reference
+
+
+def test_partition_tree(tree_multitext):
+    tokens, _, attention_mask, _, index_maps = tree_multitext.prepare_inputs(return_index_maps=True)
+    partition = partition_tree(tree_multitext, index_maps, nr_parts=2)
+
+    first = list(tree_multitext.vertices)[0]
+    assert partition.trunk_token_indices.tolist() == list(range(len(first.component.value)))
+    all_indices = np.concatenate([partition.trunk_token_indices] + partition.part_token_indices)
+    assert sorted(all_indices.tolist()) == list(range(len(tokens)))
+
+    # the tokens of each part only attend to the trunk and to the part itself
+    attention_mask = np.array(attention_mask)
+    for part in partition.part_token_indices:
+        assert len(part) > 0
+        allowed = np.concatenate([partition.trunk_token_indices, part])
+        assert not np.delete(attention_mask[part], allowed, axis=1).any()
+
+
+def test_run_distributed_forward(tiny_model, tree_multitext):
+    for pos_method in MultiText.PositioningMethod:
+        tokens, positions, attention_mask, _ = tree_multitext.prepare_inputs(pos_method=pos_method)
+        with torch.no_grad():
+            expected = tiny_model(
+                input_ids=torch.LongTensor([tokens]), position_ids=torch.LongTensor([positions]),
+                attention_mask=torch.LongTensor(attention_mask)[None, None], use_cache=False,
+            ).last_hidden_state
+        result = run_distributed_forward(tiny_model, tree_multitext, nr_processes=2, pos_method=pos_method)
+        assert torch.allclose(result, expected, atol=1e-5)
+
+
+def test_run_distributed_forward_raises(tiny_model, tree_multitext):
+    # a token outside of the vocabulary in one of the subtrees fails the forward of a single process
+    leaf = [v for v in tree_multitext.vertices if len(v.children) == 0][0]
+    leaf.component = Reference([10_000])
+    with pytest.raises(IndexError):
+        run_distributed_forward(tiny_model, tree_multitext, nr_processes=2)
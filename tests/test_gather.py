@@ -0,0 +1,26 @@
+import torch
+
+from tokens_in_common.data import OptionStringBuildMode, multitext_from_option_strings
+from tokens_in_common.modeling.gather import gather_leaves, gather_paths, gather_vertices
+
+
+def test_gather(sample):
+    multitext = multitext_from_option_strings(OptionStringBuildMode.STANDARD, sample)
+    tokens, _, _, _, index_maps = multitext.prepare_inputs(return_index_maps=True)
+    states = torch.randn(1, len(tokens), 8)
+
+    paths, valid = gather_paths(states, index_maps)
+    assert paths.shape == (1, 6, index_maps.path_token_indices.shape[1], 8)
+    for i, indices in enumerate(index_maps.path_token_indices):
+        length = index_maps.path_lengths[i]
+        assert torch.equal(paths[0, i, :length], states[0, indices[:length]])
+        assert valid[i].sum() == length
+        assert (paths[0, i, length:] == 0).all()
+
+    leaves = gather_leaves(states, index_maps)
+    assert torch.equal(leaves[0], states[0, index_maps.leaf_last_token])
+
+    vertices, valid = gather_vertices(states, index_maps)
+    for i, (start, end) in enumerate(index_maps.vertex_spans):
+        assert torch.equal(vertices[0, i, :end - start], states[0, start:end])
+        assert valid[i].sum() == end - start
@@ -0,0 +1,115 @@
+import torch
+
+from tokens_in_common.benchmark import tiny_llama_config
+from tokens_in_common.modeling.llama import LlamaForCausalLM, LlamaModel
+from tokens_in_common.multitext import MultiText
+
+@torch.no_grad()
+def test_capture_hidden_states(tiny_model, tree_inputs):
+    inputs, index_maps = tree_inputs()
+    leaf_tokens = torch.as_tensor(index_maps.leaf_last_token)
+
+    full = tiny_model(**inputs, output_hidden_states=True)
+    outputs = tiny_model(**inputs, capture_layers=[1, -1], capture_token_indices=leaf_tokens)
+    assert outputs.hidden_states is None
+    assert len(outputs.captured_hidden_states) == 2
+    assert torch.equal(outputs.captured_hidden_states[0], full.hidden_states[1][:, leaf_tokens])
+    assert torch.equal(outputs.captured_hidden_states[1], full.hidden_states[3][:, leaf_tokens])
+
+    streamed = []
+    outputs = tiny_model(
+        **inputs, capture_layers=[0, 2], capture_callback=lambda layer_idx, states: streamed.append((layer_idx, states))
+    )
+    assert outputs.captured_hidden_states is None
+    assert [layer_idx for layer_idx, _ in streamed] == [0, 2]
+    assert torch.equal(streamed[1][1], full.hidden_states[2])
+
+
+@torch.no_grad()
+def test_stop_at_layer(tmp_path, tiny_model, tree_inputs):
+    inputs, _ = tree_inputs()
+
+    full = tiny_model(**inputs, output_hidden_states=True)
+    outputs = tiny_model(**inputs, stop_at_layer=1, output_hidden_states=True)
+    assert torch.equal(outputs.last_hidden_state, full.hidden_states[1])
+    assert len(outputs.hidden_states) == 2
+    normalized = tiny_model(**inputs, stop_at_layer=-3, normalize_at_stop=True)
+    assert torch.equal(normalized.last_hidden_state, tiny_model.norm(full.hidden_states[1]))
+
+    # loading only the first layers yields the same states
+    tiny_model.save_pretrained(tmp_path)
+    truncated = LlamaModel.from_pretrained(tmp_path, num_hidden_layers=1).eval()
+    assert len(truncated.layers) == 1
+    assert torch.allclose(truncated(**inputs).last_hidden_state, normalized.last_hidden_state)
+
+    tiny_model.truncate_layers(1)
+    assert tiny_model.config.num_hidden_layers == 1
+    assert torch.equal(tiny_model(**inputs).last_hidden_state, normalized.last_hidden_state)
+
+
+def test_tree_loss(tree_multitext, tree_inputs):
+    torch.manual_seed(0)
+    model = LlamaForCausalLM(tiny_llama_config(vocab_size=128, num_hidden_layers=2))
+    inputs, index_maps = tree_inputs(MultiText.PositioningMethod.NO_ALIGNMENT)
+
+    # the tree loss averages the losses of the separate leaf ancestries
+    with torch.no_grad():
+        naive_losses = []
+        for ancestry in tree_multitext.get_leaf_ancestries():
+            tokens = torch.LongTensor([sum((v.component.value for v in ancestry), start=[])])
+            causal_mask = torch.tril(torch.ones(tokens.shape[1], tokens.shape[1], dtype=torch.long))[None, None]
+            naive_losses.append(model(input_ids=tokens, attention_mask=causal_mask, labels=tokens).loss)
+
+    model.gradient_checkpointing_enable()
+    model.train()
+    outputs = model(
+        **inputs, labels=inputs['input_ids'], use_cache=False,
+        label_predecessors=torch.as_tensor(index_maps.token_predecessors)[None],
+        label_weights=torch.as_tensor(index_maps.token_loss_weights, dtype=torch.float)[None],
+    )
+    assert torch.allclose(outputs.loss, torch.stack(naive_losses).mean(), atol=1e-5)
+
+    outputs.loss.backward()
+    assert model.model.embed_tokens.weight.grad is not None
+
+
+@torch.no_grad()
+def test_output_token_pruning(tiny_model, tree_inputs):
+    for pos_method in MultiText.PositioningMethod:
+        inputs, index_maps = tree_inputs(pos_method)
+        expected = tiny_model(**inputs, use_cache=False).last_hidden_state
+        # the last tokens of the leaves, in a different order than they appear in
+        output_tokens = torch.as_tensor(index_maps.leaf_last_token).flip(0)
+
+        for nr_pruned_layers in [1, 2, 3]:
+            hidden_states = tiny_model(
+                **inputs, output_token_indices=output_tokens, nr_pruned_layers=nr_pruned_layers
+            ).last_hidden_state
+            assert hidden_states.shape == (1, len(output_tokens), expected.shape[-1])
+            assert torch.allclose(hidden_states, expected[:, output_tokens], atol=1e-5)
+
+
+@torch.no_grad()
+def test_sparse_attentions(tiny_model, tree_inputs):
+    inputs, index_maps = tree_inputs()
+    dense = tiny_model(**inputs, use_cache=False, output_attentions=True).attentions
+    outputs = tiny_model(
+        **inputs, use_cache=False, output_sparse_attentions=True,
+        attention_vertex_indices=torch.as_tensor(index_maps.token_vertex_indices),
+    )
+    assert outputs.attentions is None
+
+    mask = inputs['attention_mask'][:, 0].bool()
+    b, q, k = outputs.sparse_attention_indices.T
+    assert len(b) == mask.sum() and mask[b, q, k].all()
+
+    one_hot = torch.nn.functional.one_hot(torch.as_tensor(index_maps.token_vertex_indices)).float()
+    for weights, sparse, vertex in zip(dense, outputs.sparse_attentions, outputs.vertex_attentions):
+        assert torch.allclose(sparse, weights[b, :, q, k])
+        # all attention falls within the mask
+        row_sums = torch.zeros(len(mask[0]), sparse.shape[1]).index_add_(0, q, sparse)
+        assert torch.allclose(row_sums, torch.ones_like(row_sums), atol=1e-5)
+
+        expected = one_hot.T @ weights @ one_hot / one_hot.sum(dim=0).view(-1, 1)
+        assert torch.allclose(vertex, expected, atol=1e-5)
+        assert torch.allclose(vertex.sum(dim=-1), torch.ones_like(vertex[..., 0]), atol=1e-5)
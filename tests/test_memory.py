@@ -0,0 +1,76 @@
+import torch
+
+from tokens_in_common.benchmark import tiny_llama_config
+from tokens_in_common.data import OptionStringBuildMode, multitext_from_option_strings
+from tokens_in_common.modeling.memory import fit_memory_budget, plan_forward_memory
+from tokens_in_common.utils import Reference
+
+
+def test_plan_forward_memory(sample):
+    multitext = multitext_from_option_strings(OptionStringBuildMode.STANDARD, sample)
+    config = tiny_llama_config()
+
+    plan = plan_forward_memory(multitext, config)
+    assert plan.nr_tokens == sum(len(v.component.value) for v in multitext.vertices)
+    assert plan.peak_bytes == sum(plan.breakdown.values())
+
+    larger = plan_forward_memory(multitext, config, output_attentions=True, output_hidden_states=True)
+    assert larger.peak_bytes > plan.peak_bytes
+    assert 'attentions' in larger.breakdown
+
+
+def test_fit_memory_budget(sample):
+    multitext = multitext_from_option_strings(OptionStringBuildMode.STANDARD, sample)
+    config = tiny_llama_config()
+    kwargs = dict(output_attentions=True, use_cache=False)
+    plan = plan_forward_memory(multitext, config, **kwargs)
+    without_attentions = plan_forward_memory(multitext, config)
+
+    advice = fit_memory_budget(multitext, config, plan.peak_bytes, **kwargs)
+    assert advice.fits and advice.drop_outputs == [] and advice.multitexts is None
+
+    advice = fit_memory_budget(multitext, config, without_attentions.peak_bytes, **kwargs)
+    assert advice.fits and advice.drop_outputs == ['attentions'] and advice.multitexts is None
+
+    # keeping the attentions requires splitting the tree
+    advice = fit_memory_budget(multitext, config, without_attentions.peak_bytes, keep_outputs=['attentions'], **kwargs)
+    assert advice.fits and advice.drop_outputs == []
+    assert len(advice.multitexts) > 1
+    assert sum(len(group) for group in advice.leaf_groups) == 6
+    assert sum(len(list(m.get_leaf_ancestries())) for m in advice.multitexts) == 6
+    assert all(plan_forward_memory(m, config, **kwargs).peak_bytes <= advice.plan.peak_bytes for m in advice.multitexts)
+
+
+@torch.no_grad()
+def test_fit_memory_budget_positions(tiny_model, sample):
+    # the options of the first branching point are reordered, such that the parts' own FULL_ALIGNMENT positions differ
+    reordered = [sample[0], ('false.', 'true.')] + sample[2:]
+    multitext = multitext_from_option_strings(OptionStringBuildMode.STANDARD, reordered)
+    multitext = multitext.copy({id(v): Reference([ord(c) for c in v.component.value]) for v in multitext.vertices})
+    kwargs = dict(output_attentions=True, use_cache=False)
+    budget = plan_forward_memory(multitext, tiny_model.config).peak_bytes
+    advice = fit_memory_budget(multitext, tiny_model.config, budget, keep_outputs=['attentions'], **kwargs)
+    assert len(advice.multitexts) > 1
+
+    def forward(m, position_ids=None):
+        tokens, positions, attention_mask, _, index_maps = m.prepare_inputs(return_index_maps=True)
+        states = tiny_model(
+            input_ids=torch.LongTensor([tokens]), position_ids=torch.LongTensor([position_ids or positions]),
+            attention_mask=torch.LongTensor(attention_mask)[None, None], use_cache=False
+        ).last_hidden_state[0]
+        return positions, index_maps, states
+
+    full_positions, full_maps, full_states = forward(multitext)
+    leaves = {id(ancestry[-1]): i for i, ancestry in enumerate(multitext.get_leaf_ancestries())}
+    vertices = {id(v): i for i, v in enumerate(multitext.vertices)}
+    for group, part, position_ids in zip(advice.leaf_groups, advice.multitexts, advice.position_ids):
+        # the parts keep the positions of their vertices in the full tree, and their leaves the same outputs
+        ids = {id(v) for leaf in group for v in leaf.get_ancestry(include_self=True)}
+        originals = [v for v in multitext.vertices if id(v) in ids]
+        _, index_maps, states = forward(part, position_ids)
+        for v, (start, end) in zip(originals, index_maps.vertex_spans):
+            full_start, full_end = full_maps.vertex_spans[vertices[id(v)]]
+            assert position_ids[start:end] == full_positions[full_start:full_end]
+        for leaf, last_token in zip(group, index_maps.leaf_last_token):
+            expected = full_states[full_maps.leaf_last_token[leaves[id(leaf)]]]
+            assert torch.allclose(states[last_token], expected, atol=1e-5)
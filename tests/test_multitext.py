@@ -0,0 +1,137 @@
+import hashlib
+
+import pytest
+from transformers import LlamaConfig
+
+from tokens_in_common.data import OptionStringBuildMode, multitext_from_option_strings
+from tokens_in_common.multitext import MultiText
+from tokens_in_common.utils import Reference
+
+
+def test_sharing_report(sample):
+    for mode in OptionStringBuildMode:
+        multitext = multitext_from_option_strings(mode, sample)
+        report = multitext.sharing_report()
+
+        tokens, _, attention_mask, _ = multitext.prepare_inputs()
+        leaf_ancestries = list(multitext.get_leaf_ancestries())
+
+        assert report.nr_tokens == len(tokens)
+        assert report.nr_leaves == len(leaf_ancestries) == 6
+        assert report.nr_path_tokens == sum(len(v.component.value) for a in leaf_ancestries for v in a)
+        assert report.nr_attended_pairs == sum(sum(row) for row in attention_mask)
+        assert 0 < report.mask_density <= 1
+
+        if mode == OptionStringBuildMode.FULL:
+            assert report.compression_ratio == 1
+            assert report.mlp_flops == report.naive_mlp_flops
+        else:
+            assert report.compression_ratio > 1
+            assert report.flops < report.naive_flops
+
+
+def test_prepare_inputs_index_maps(sample):
+    multitext = multitext_from_option_strings(OptionStringBuildMode.STANDARD, sample)
+    tokens, _, attention_mask, token_vertex_elements, index_maps = multitext.prepare_inputs(return_index_maps=True)
+
+    for v, (start, end), indices in zip(multitext.vertices, index_maps.vertex_spans, index_maps.vertex_token_indices):
+        assert "".join(tokens[start:end]) == v.component.value
+        assert all(token_vertex_elements[i][0] is v.component for i in indices if i >= 0)
+
+    for ancestry, length, indices, last in zip(multitext.get_leaf_ancestries(), index_maps.path_lengths,
+                                               index_maps.path_token_indices, index_maps.leaf_last_token):
+        assert "".join(tokens[i] for i in indices[:length]) == "".join(v.component.value for v in ancestry)
+        assert all(i == -1 for i in indices[length:])
+        assert last == indices[length - 1]
+        # the last token of each leaf attends to exactly the tokens in its path
+        assert [j for j, attends in enumerate(attention_mask[last]) if attends] == sorted(indices[:length])
+
+
+def test_prepare_inputs_token_predecessors(sample):
+    multitext = multitext_from_option_strings(OptionStringBuildMode.STANDARD, sample)
+    *_, index_maps = multitext.prepare_inputs(return_index_maps=True)
+
+    for length, indices in zip(index_maps.path_lengths, index_maps.path_token_indices):
+        assert index_maps.token_predecessors[indices[0]] == -1
+        assert all(index_maps.token_predecessors[b] == a for a, b in zip(indices[:length - 1], indices[1:length]))
+    assert abs(index_maps.token_loss_weights.sum() - 1) < 1e-9
+
+
+def test_structure_validators(sample):
+    structure = {mode: multitext_from_option_strings(mode, sample) for mode in OptionStringBuildMode}
+    assert all(m.is_causal() and m.is_multitree() for m in structure.values())
+    assert structure[OptionStringBuildMode.STANDARD].is_tree()
+    assert structure[OptionStringBuildMode.FULL].is_forest() and not structure[OptionStringBuildMode.FULL].is_tree()
+    assert not structure[OptionStringBuildMode.FRUGAL].is_forest()
+
+    # a diamond has two paths between its top and bottom, and adding a vertex invalidates the cached results
+    elements = [(Reference("a"), 0), (Reference("b"), 1), (Reference("c"), 1)]
+    multitext = MultiText.from_vertex_elements(elements, [[], [0], [0]])
+    b, c = list(multitext.vertices)[1:]
+    assert multitext.is_tree() and multitext.is_multitree()
+    multitext.add_vertex(Reference("d"), 2, parents=[b, c])
+    assert not multitext.is_forest() and not multitext.is_multitree() and multitext.is_causal()
+
+    with pytest.raises(ValueError):
+        MultiText.from_vertex_elements(elements, [[2], [0], [1]])
+
+
+def test_prepare_inputs_forest_fast_path(sample):
+    for mode in [OptionStringBuildMode.FULL, OptionStringBuildMode.STANDARD]:
+        multitext = multitext_from_option_strings(mode, sample)
+        for pos_method in MultiText.PositioningMethod:
+            assert multitext._prepare_forest_inputs(pos_method) == multitext._prepare_dag_inputs(pos_method)
+
+
+def diamond_chain(nr_levels):
+    # a chain of diamonds, with 2 ** nr_levels paths from the top to the bottom
+    elements, parent_indices = [(Reference("top"), 0)], [[]]
+    for level in range(nr_levels):
+        bottom = len(elements) - 1
+        elements += [(Reference("l"), 2 * level + 1), (Reference("r"), 2 * level + 1), (Reference("b"), 2 * level + 2)]
+        parent_indices += [[bottom], [bottom], [bottom + 1, bottom + 2]]
+    return MultiText.from_vertex_elements(elements, parent_indices)
+
+
+def test_sharing_report_dag():
+    # the ancestors of each vertex are counted once, however many paths lead to them
+    small = diamond_chain(3)
+    _, _, attention_mask, _ = small.prepare_inputs()
+    assert small.sharing_report().nr_attended_pairs == sum(sum(row) for row in attention_mask)
+    report = diamond_chain(40).sharing_report()
+    assert report.nr_leaves == 1 and report.nr_path_tokens == report.nr_tokens == 3 + 3 * 40
+
+    # the key and value projections shrink with the number of key/value heads
+    n, h, nr_layers = small.sharing_report().nr_tokens, 64, 2
+    for nr_kv_heads in [4, 1]:
+        config = LlamaConfig(hidden_size=h, intermediate_size=128, num_hidden_layers=nr_layers, num_attention_heads=4,
+                             num_key_value_heads=nr_kv_heads)
+        kv_dim = nr_kv_heads * h // 4
+        report = small.sharing_report(config)
+        assert report.attention_flops == nr_layers * (4 * n * h * (h + kv_dim) + 4 * n ** 2 * h)
+        assert report.mlp_flops == nr_layers * 6 * n * h * 128
+
+
+def test_add_vertex_rejects_cycles():
+    multitext = diamond_chain(40)
+    vertices = list(multitext.vertices)
+
+    with pytest.raises(ValueError):
+        multitext.add_vertex(Reference("x"), 82, parents=[vertices[-1]], children=[vertices[0]])
+    multitext.add_vertex(Reference("x"), 1, parents=[vertices[0]], children=[vertices[-1]])
+    assert not multitext.is_multitree()
+
+
+def test_stable_ancestral_hash_dag():
+    # equal to hashing the deduplicated ancestry, without enumerating the paths to the ancestors
+    def expected(v):
+        ancestry = {id(a): a for a in v.get_ancestry(include_self=True)}.values()
+        return hashlib.blake2b(
+            "".join(a.component.value for a in sorted(ancestry, key=lambda a: a.position)).encode('utf-8'),
+            digest_size=16
+        ).digest()
+
+    assert all(v.calc_stable_ancestral_hash() == expected(v) for v in diamond_chain(4).vertices)
+    bottom = list(diamond_chain(60).vertices)[-1]
+    assert bottom.calc_stable_ancestral_hash() == hashlib.blake2b(("top" + "lrb" * 60).encode('utf-8'),
+                                                                   digest_size=16).digest()
@@ -0,0 +1,23 @@
+import torch
+
+from tokens_in_common.data import OptionStringBuildMode, multitext_from_option_strings
+from tokens_in_common.parallel import SharedModelExecutor, prepare_batch
+from tokens_in_common.utils import Reference
+
+
+def test_shared_model_executor(tiny_model, sample):
+    batches = []
+    for mode in OptionStringBuildMode:
+        multitext = multitext_from_option_strings(mode, sample)
+        multitext = multitext.copy({id(v): Reference([ord(c) for c in v.component.value]) for v in multitext.vertices})
+        batches.append(prepare_batch(multitext))
+
+    with SharedModelExecutor(tiny_model, nr_workers=2) as executor:
+        assert all(p.is_shared() for p in tiny_model.parameters())
+        outputs = executor.map(batches)
+        # inputs may include use_cache
+        assert torch.equal(executor.submit(**batches[0], use_cache=True).result(), outputs[0])
+
+    with torch.no_grad():
+        for batch, output in zip(batches, outputs):
+            assert torch.allclose(output, tiny_model(**batch, use_cache=False).last_hidden_state, atol=1e-5)
@@ -0,0 +1,46 @@
+import torch
+
+from tokens_in_common import profiling
+from tokens_in_common.profiling import Profiler
+
+
+def test_profiler(tiny_model, tree_multitext):
+    assert profiling.stage('prepare_inputs') is profiling.stage('decoder_layer', index=0)
+
+    records = []
+    with Profiler(callback=lambda *record: records.append(record)) as profiler:
+        tokens, positions, attention_mask, _, _ = tree_multitext.prepare_inputs(return_index_maps=True)
+        with torch.no_grad():
+            tiny_model(input_ids=torch.LongTensor([tokens]), position_ids=torch.LongTensor([positions]),
+                       attention_mask=torch.LongTensor(attention_mask)[None, None], use_cache=False)
+        profiling.count('trees')
+
+    nr_layers = tiny_model.config.num_hidden_layers
+    expected = {'prepare_inputs', 'prepare_inputs.index_maps', 'get_leaf_ancestries', 'mask_conversion'}
+    assert set(profiler.stages) == expected | {f'decoder_layer.{i}' for i in range(nr_layers)}
+    assert profiler.stages['get_leaf_ancestries'].nr_calls == 6
+    assert profiler.stages['prepare_inputs'].nr_tokens == len(tokens)
+    assert all(profiler.stages[f'decoder_layer.{i}'].nr_tokens == len(tokens) for i in range(nr_layers))
+    assert all(stats.wall_time > 0 and stats.peak_rss >= 0 for stats in profiler.stages.values())
+    assert profiler.counters == {'trees': 1}
+    assert len(records) == sum(stats.nr_calls for stats in profiler.stages.values())
+    assert 'decoder_layer.0' in profiler.summary()
+
+    # nothing is recorded once the profiler is no longer active
+    tree_multitext.prepare_inputs()
+    assert profiler.stages['prepare_inputs'].nr_calls == 1
+
+
+def test_profiler_peak_rss():
+    with Profiler() as profiler:
+        # every call is measured from its own start, so a repeated allocation is reported each time
+        for _ in range(2):
+            with profiling.stage('allocate'):
+                # written to, so that the pages are resident
+                x = torch.ones(16 * 2 ** 20)
+            del x
+            with profiling.stage('cheap'):
+                torch.ones(10)
+            assert profiler.stages['allocate'].peak_rss >= 48 * 2 ** 20
+            assert profiler.stages['cheap'].peak_rss < 16 * 2 ** 20
+            profiler.stages.clear()
@@ -0,0 +1,98 @@
+import torch
+
+from tokens_in_common.benchmark import tiny_llama_config
+from tokens_in_common.modeling.llama import LlamaForCausalLM
+from tokens_in_common.multitext import MultiText
+from tokens_in_common.search import rank_options, tree_beam_search
+from tokens_in_common.utils import Reference
+
+
+def tiny_causal_lm():
+    torch.manual_seed(0)
+    return LlamaForCausalLM(tiny_llama_config(vocab_size=32)).eval()
+
+
+def prompt_multitext():
+    # a shared prefix followed by two options
+    elements = [(Reference([1, 5, 9, 3]), 0), (Reference([7, 2]), 1), (Reference([4]), 1)]
+    return MultiText.from_vertex_elements(elements, [[], [0], [0]])
+
+
+@torch.no_grad()
+def path_log_prob(model, ancestry, nr_generated):
+    tokens = sum((v.component.value for v in ancestry), start=[])
+    mask = torch.tril(torch.ones(len(tokens), len(tokens), dtype=torch.long))[None, None]
+    log_probs = model(input_ids=torch.LongTensor([tokens]), attention_mask=mask).logits[0].log_softmax(dim=-1)
+    return sum(log_probs[i - 1, tokens[i]].item() for i in range(len(tokens) - nr_generated, len(tokens)))
+
+
+def test_tree_beam_search():
+    model = tiny_causal_lm()
+    prompt = prompt_multitext()
+    multitext, scores = tree_beam_search(
+        model, prompt, nr_steps=3, beam_width=2, top_k=2, pos_method=MultiText.PositioningMethod.NO_ALIGNMENT
+    )
+
+    assert len(list(prompt.vertices)) == 3
+    assert len(list(multitext.vertices)) == 3 + 3 * 2 * 2
+    assert len(scores) == 3 * 2 * 2
+
+    # the scores equal the log-probabilities of the generated tokens when forwarding each path separately
+    vertices = {id(v): v for v in multitext.vertices}
+    for vertex_id, score in scores.items():
+        ancestry = sorted(vertices[vertex_id].get_ancestry(include_self=True), key=lambda v: v.position)
+        nr_generated = sum(id(v) in scores for v in ancestry)
+        assert abs(score - path_log_prob(model, ancestry, nr_generated)) < 1e-4
+
+    # the first step expands both options with their two most likely tokens
+    first = [v for v in multitext.vertices if v.position == 2]
+    assert len(first) == 4 and all(len(v.parents) == 1 and v.parents[0].position == 1 for v in first)
+
+
+def test_tree_beam_search_ranks_paths():
+    model = tiny_causal_lm()
+    # more prompt leaves than the beam is wide, of which a short one is far more likely than the others
+    generator = torch.Generator().manual_seed(0)
+    options = [torch.randint(32, (length,), generator=generator).tolist() for length in [1, 4, 4, 4, 4, 4]]
+    elements = [(Reference([1, 5, 9, 3]), 0)] + [(Reference(option), 1) for option in options]
+    prompt = MultiText.from_vertex_elements(elements, [[]] + [[0]] * len(options))
+    multitext, scores = tree_beam_search(
+        model, prompt, nr_steps=6, beam_width=1, top_k=2, pos_method=MultiText.PositioningMethod.NO_ALIGNMENT
+    )
+
+    def full_log_prob(v):
+        ancestry = sorted(v.get_ancestry(include_self=True), key=lambda u: u.position)
+        return path_log_prob(model, ancestry, sum(len(u.component.value) for u in ancestry) - 1)
+
+    # the best branches are grown, rather than expanding every prompt leaf once
+    assert max(v.position for v in multitext.vertices) > 2
+    # every expanded vertex was the best leaf when it was expanded, so it outranks the prompt leaves never expanded
+    options = [v for v in multitext.vertices if v.position == 1]
+    expanded = [v for v in multitext.vertices if v.position > 0 and len(v.children) > 0]
+    unexpanded = [v for v in options if len(v.children) == 0]
+    assert len(expanded) == 6 and len(unexpanded) > 0
+    assert min(map(full_log_prob, expanded)) >= max(map(full_log_prob, unexpanded)) - 1e-4
+
+
+def test_rank_options():
+    model = tiny_causal_lm()
+    # a short option and several long ones, which are dropped once they fall below the short option
+    generator = torch.Generator().manual_seed(1)
+    options = [[3, 8]] + [torch.randint(32, (24,), generator=generator).tolist() for _ in range(4)]
+    elements = [(Reference([1, 5, 9, 3]), 0)] + [(Reference(option), 1) for option in options]
+    multitext = MultiText.from_vertex_elements(elements, [[]] + [[0]] * len(options))
+    leaves = [v for v in multitext.vertices if len(v.children) == 0]
+    # every token but the first is scored
+    expected = sorted(((v, path_log_prob(model, [v.parents[0], v], 3 + len(v.component.value))) for v in leaves),
+                      key=lambda x: x[1], reverse=True)
+
+    for k in [1, 2]:
+        result = rank_options(model, multitext, k=k, chunk_size=4, max_frontier=1)
+        assert [v for v, _ in result.top] == [v for v, _ in expected[:k]]
+        assert all(abs(score - exp) < 1e-4 for (_, score), (_, exp) in zip(result.top, expected))
+        assert result.nr_tokens_total == 4 + 2 + 4 * 24
+    assert rank_options(model, multitext, k=1, chunk_size=4, max_frontier=1).nr_tokens_forwarded < 4 + 2 + 4 * 24
+
+    # all options are forwarded when k covers them
+    result = rank_options(model, multitext, k=len(options))
+    assert len(result.top) == len(options) and result.nr_tokens_forwarded == result.nr_tokens_total
@@ -0,0 +1,108 @@
+import asyncio
+import json
+
+import torch
+
+from tokens_in_common.benchmark import tiny_llama_config, train_tokenizer
+from tokens_in_common.modeling.llama import LlamaForCausalLM
+from tokens_in_common.server import TreeBatchingServer, multitext_from_json
+
+TEST_REQUESTS = [
+    dict(option_strings=['The sentence "Four children are playing." is ', ['true.', 'false.']]),
+    dict(option_strings=['The children are ', ['wet.', 'dry.', 'happy.']], outputs=['scores', 'hidden_states']),
+    dict(vertices=[['Therefore, the children are ', 0], ['wet.', 1], ['dry.', 1]], parents=[[], [0], [0]]),
+]
+
+
+def make_server(**kwargs):
+    tokenizer = train_tokenizer([
+        'The sentence "Four children are playing." is true. The children are wet. Therefore, they are dry or happy.'
+    ], vocab_size=100)
+    torch.manual_seed(0)
+    model = LlamaForCausalLM(tiny_llama_config(vocab_size=tokenizer.get_vocab_size()))
+    return TreeBatchingServer(model, tokenizer.encode, **kwargs)
+
+
+async def post(address, body):
+    if isinstance(address, str):
+        reader, writer = await asyncio.open_unix_connection(address)
+    else:
+        reader, writer = await asyncio.open_connection(*address[:2])
+    payload = json.dumps(body).encode()
+    writer.write(f'POST / HTTP/1.1\r\nContent-Length: {len(payload)}\r\n\r\n'.encode() + payload)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, body = response.partition(b'\r\n\r\n')
+    return head.split(b' ')[1].decode(), json.loads(body)
+
+
+def test_server_batches_requests(tmp_path):
+    async def run():
+        # each request forwarded separately
+        solo_server = make_server(max_latency=0)
+        solo = []
+        for request in TEST_REQUESTS:
+            solo.append(await solo_server.submit(multitext_from_json(request), request.get('outputs', ['scores'])))
+        await solo_server.close()
+        assert solo_server.nr_forwards == 3
+
+        # concurrent requests forwarded together
+        server = make_server(max_latency=0.5)
+        address = await server.start()
+        responses = await asyncio.gather(*(post(address, request) for request in TEST_REQUESTS))
+        await server.close()
+        assert server.nr_forwards == 1
+
+        for (status, response), expected in zip(responses, solo):
+            assert status == '200'
+            assert [leaf['text'] for leaf in response['leaves']] == [leaf['text'] for leaf in expected]
+            for leaf, expected_leaf in zip(response['leaves'], expected):
+                assert abs(leaf['scores'] - expected_leaf['scores']) < 1e-4
+                if 'hidden_states' in expected_leaf:
+                    assert torch.allclose(
+                        torch.tensor(leaf['hidden_states']), torch.tensor(expected_leaf['hidden_states']), atol=1e-5
+                    )
+        assert len(responses[1][1]['leaves']) == 3
+
+        # on a unix socket, with an invalid request
+        server = make_server()
+        address = await server.start(path=str(tmp_path / 'server.sock'))
+        status, response = await post(address, dict(text='The children are wet.'))
+        await server.close()
+        assert status == '400' and 'error' in response
+
+    asyncio.run(run())
+
+
+def test_server_isolates_failing_requests():
+    malformed = dict(vertices=[['The children ', 0], ['are wet.', 3]], parents=[[], [0]])
+
+    class FailingServer(TreeBatchingServer):
+        def _forward(self, batch):
+            if any(v.component.value == 'happy.' for r in batch for v in r.multitext.vertices):
+                raise RuntimeError('boom')
+            return super()._forward(batch)
+
+    async def run():
+        server = make_server(max_latency=0.5)
+        address = await server.start()
+        (status, response), (bad_status, bad_response) = await asyncio.gather(
+            post(address, TEST_REQUESTS[0]), post(address, malformed)
+        )
+        await server.close()
+        assert status == '200' and len(response['leaves']) == 2
+        assert bad_status == '400' and 'contiguous' in bad_response['error']
+
+        # a batch whose forward fails is retried per request
+        server = make_server(max_latency=0.5)
+        server.__class__ = FailingServer
+        failing = dict(option_strings=['The children are ', ['wet.', 'happy.']])
+        results = await asyncio.gather(
+            server.submit(multitext_from_json(TEST_REQUESTS[0])), server.submit(multitext_from_json(failing)),
+            return_exceptions=True,
+        )
+        await server.close()
+        assert len(results[0]) == 2 and isinstance(results[1], RuntimeError)
+
+    asyncio.run(run())
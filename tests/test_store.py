@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+from tokens_in_common.data import OptionStringBuildMode, multitext_from_option_strings
+from tokens_in_common.store import ResultStore
+
+
+def leaf_hashes(mode, sample):
+    multitext = multitext_from_option_strings(mode, sample)
+    return [ancestry[-1].calc_stable_ancestral_hash() for ancestry in multitext.get_leaf_ancestries()]
+
+
+def test_stable_ancestral_hash(sample):
+    # the leaves of each build mode represent the same texts
+    hashes = {mode: leaf_hashes(mode, sample) for mode in OptionStringBuildMode}
+    assert len(set(hashes[OptionStringBuildMode.FULL])) == 6
+    assert all(set(h) == set(hashes[OptionStringBuildMode.FULL]) for h in hashes.values())
+
+
+def test_result_store(tmp_path, sample):
+    keys = leaf_hashes(OptionStringBuildMode.STANDARD, sample)
+    values = np.random.default_rng(0).normal(size=(len(keys), 3, 4)).astype(np.float32)
+
+    store = ResultStore(tmp_path / 'store', shape=(3, 4), dtype=np.float32, chunk_size=2)
+    # two writers, e.g. in separate processes, that each write some of the results
+    with store.writer('a') as writer_a, store.writer('b') as writer_b:
+        writer_a.extend(keys[:4], values[:4])
+        writer_b.extend(keys[4:], values[4:])
+    assert len(store) == 0
+    store.refresh()
+    assert len(store) == len(keys) and len(list((tmp_path / 'store').glob('*.keys'))) == 3
+
+    # an interrupted write without a key is ignored
+    with open(tmp_path / 'store' / 'b.000000.values', 'ab') as f:
+        f.write(values[0].tobytes())
+
+    reopened = ResultStore(tmp_path / 'store')
+    assert reopened.shape == (3, 4) and reopened.dtype == np.float32
+    for key, value in zip(keys, values):
+        assert key in reopened
+        assert np.array_equal(reopened[key], value)
+    assert b'\0' * 16 not in reopened and reopened.get(b'\0' * 16) is None
+    assert sorted(reopened.keys()) == sorted(keys)
+
+    with pytest.raises(ValueError):
+        ResultStore(tmp_path / 'store', shape=(4,), dtype=np.float32)
+    with pytest.raises(ValueError):
+        store.writer().append(keys[0], values[0, 0])